@@ -5,13 +5,24 @@
 # LICENSE file in the root directory of this source tree.
 
 import cv2  # type: ignore
+import numpy as np
+import torch
+import torch.multiprocessing as mp
 
 from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
+from segment_anything.modeling import Sam
+from segment_anything.utils.amg import SharedMemoryFeatureCache
+from segment_anything.utils.annotations import MaskAnnotations
+from segment_anything.utils.mask_archive import write_mask_archive
 
 import argparse
 import json
 import os
-from typing import Any, Dict, List
+import queue
+import threading
+from collections import deque
+from multiprocessing.process import BaseProcess
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 parser = argparse.ArgumentParser(
     description=(
@@ -34,7 +45,8 @@ parser.add_argument(
     required=True,
     help=(
         "Path to the directory where masks will be output. Output will be either a folder "
-        "of PNGs per image or a single json with COCO-style masks."
+        "of PNGs per image, a single json with COCO-style masks per image with "
+        "--convert-to-rle, or a single '.masks' archive per image with --mask-archive."
     ),
 )
 
@@ -54,7 +66,9 @@ parser.add_argument(
 
 parser.add_argument("--device", type=str, default="cuda", help="The device to run generation on.")
 
-parser.add_argument(
+output_format = parser.add_mutually_exclusive_group()
+
+output_format.add_argument(
     "--convert-to-rle",
     action="store_true",
     help=(
@@ -63,6 +77,92 @@ parser.add_argument(
     ),
 )
 
+output_format.add_argument(
+    "--mask-archive",
+    type=str,
+    choices=["rle", "bits"],
+    default=None,
+    help=(
+        "Save all masks of an image and their metadata in a single '.masks' file instead "
+        "of as a folder of PNGs, storing masks as RLE counts or as packed bits. The file "
+        "can be memory-mapped with segment_anything.utils.mask_archive.MaskArchive."
+    ),
+)
+
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help=(
+        "The number of worker processes to generate masks with. Each worker pulls images "
+        "from a shared queue and writes its own outputs. The model is loaded once, and its "
+        "weights are shared between workers running on the CPU."
+    ),
+)
+
+parser.add_argument(
+    "--prefetch-threads",
+    type=int,
+    default=2,
+    help="The number of threads that read and decode the next images in the background.",
+)
+
+parser.add_argument(
+    "--max-queue-bytes",
+    type=int,
+    default=1 << 30,
+    help=(
+        "The most bytes held by the queue of decoded images waiting for mask generation, "
+        "and separately by the queue of masks waiting to be written."
+    ),
+)
+
+feature_cache_location = parser.add_mutually_exclusive_group()
+
+feature_cache_location.add_argument(
+    "--feature-cache-dir",
+    type=str,
+    default=None,
+    help=(
+        "A directory where image embeddings are kept between runs, so that rerunning on the "
+        "same images with other settings does not run the image encoder again. It may be "
+        "shared by several processes."
+    ),
+)
+
+parser.add_argument(
+    "--feature-cache-max-disk-bytes",
+    type=int,
+    default=None,
+    help=(
+        "If set, the least recently used embeddings are deleted from --feature-cache-dir "
+        "when it holds more than this many bytes."
+    ),
+)
+
+feature_cache_location.add_argument(
+    "--shared-feature-cache",
+    type=str,
+    default=None,
+    help=(
+        "The name of a cache of image embeddings in shared memory, which is shared by the "
+        "--workers processes and by any other process on this machine that uses the same "
+        "name. Linux only. The cache persists in /dev/shm/<name> after the run and keeps "
+        "using memory until it is removed, by deleting that directory or with "
+        "SharedMemoryFeatureCache.unlink()."
+    ),
+)
+
+parser.add_argument(
+    "--shared-feature-cache-max-bytes",
+    type=int,
+    default=None,
+    help=(
+        "The least recently used embeddings are evicted from --shared-feature-cache when "
+        "it holds more than this many bytes. Defaults to 4 GiB."
+    ),
+)
+
 amg_settings = parser.add_argument_group("AMG Settings")
 
 amg_settings.add_argument(
@@ -187,49 +287,290 @@ def get_amg_kwargs(args):
         "crop_overlap_ratio": args.crop_overlap_ratio,
         "crop_n_points_downscale_factor": args.crop_n_points_downscale_factor,
         "min_mask_region_area": args.min_mask_region_area,
+        "feature_cache_dir": args.feature_cache_dir,
+        "feature_cache_max_disk_bytes": args.feature_cache_max_disk_bytes,
     }
     amg_kwargs = {k: v for k, v in amg_kwargs.items() if v is not None}
     return amg_kwargs
 
 
+def get_targets(input_path: str) -> List[str]:
+    if not os.path.isdir(input_path):
+        return [input_path]
+    targets = [
+        f for f in os.listdir(input_path) if not os.path.isdir(os.path.join(input_path, f))
+    ]
+    return [os.path.join(input_path, f) for f in targets]
+
+
+# Seconds between checks that the --workers processes are still alive
+WORKER_POLL_INTERVAL = 5.0
+
+
+class ByteBoundedQueue:
+    """
+    A FIFO queue that blocks puts while the items it holds would exceed max_bytes.
+    An empty queue accepts any item, so that items larger than max_bytes pass.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._items: Deque[Tuple[Any, int]] = deque()
+        self._nbytes = 0
+        self._cond = threading.Condition()
+
+    def put(self, item: Any, nbytes: int = 0) -> None:
+        with self._cond:
+            while self._items and self._nbytes + nbytes > self.max_bytes:
+                self._cond.wait()
+            self._items.append((item, nbytes))
+            self._nbytes += nbytes
+            self._cond.notify_all()
+
+    def get(self) -> Any:
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            item, nbytes = self._items.popleft()
+            self._nbytes -= nbytes
+            self._cond.notify_all()
+            return item
+
+
+def load_image(t: str) -> Optional[np.ndarray]:
+    image = cv2.imread(t)
+    if image is None:
+        print(f"Could not load '{t}' as an image, skipping...")
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def write_masks(
+    masks: Union[List[Dict[str, Any]], MaskAnnotations], t: str, args: argparse.Namespace
+) -> None:
+    base = os.path.basename(t)
+    base = os.path.splitext(base)[0]
+    save_base = os.path.join(args.output, base)
+    if isinstance(masks, MaskAnnotations):
+        write_mask_archive(save_base + ".masks", masks, mask_format=args.mask_archive)
+    elif not args.convert_to_rle:
+        os.makedirs(save_base, exist_ok=False)
+        write_masks_to_folder(masks, save_base)
+    else:
+        save_file = save_base + ".json"
+        with open(save_file, "w") as f:
+            json.dump(masks, f)
+
+
+def masks_nbytes(masks: Union[List[Dict[str, Any]], MaskAnnotations]) -> int:
+    if isinstance(masks, MaskAnnotations):
+        return masks.rles.counts.nbytes
+    nbytes = 0
+    for mask_data in masks:
+        segmentation = mask_data["segmentation"]
+        if isinstance(segmentation, np.ndarray):
+            nbytes += segmentation.nbytes
+        else:
+            nbytes += len(segmentation["counts"])
+    return nbytes
+
+
+def run_pipeline(
+    generator: SamAutomaticMaskGenerator,
+    targets: Iterable[str],
+    args: argparse.Namespace,
+    report: Callable[[str, bool, Optional[str]], None],
+) -> None:
+    """
+    Generates and writes masks for each target. Images are read and decoded ahead
+    by background threads, and masks are written by another thread, so that mask
+    generation does not wait on either. report is called with each target, if it
+    was processed, and the error it raised, if any, once its masks are written.
+    """
+    targets_iter = iter(targets)
+    targets_lock = threading.Lock()
+    image_queue = ByteBoundedQueue(args.max_queue_bytes)
+    write_queue = ByteBoundedQueue(args.max_queue_bytes)
+
+    def load_images() -> None:
+        try:
+            while True:
+                with targets_lock:
+                    t = next(targets_iter, None)
+                if t is None:
+                    return
+                try:
+                    image = load_image(t)
+                    nbytes = image.nbytes if image is not None else 0
+                except Exception as e:
+                    image_queue.put((t, None, repr(e)))
+                    continue
+                image_queue.put((t, image, None), nbytes)
+        finally:
+            # The main loop waits for one sentinel from each loader
+            image_queue.put(None)
+
+    def write_all_masks() -> None:
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            t, masks = item
+            try:
+                write_masks(masks, t, args)
+            except Exception as e:
+                report(t, False, repr(e))
+            else:
+                report(t, True, None)
+
+    num_loaders = max(1, args.prefetch_threads)
+    loaders = [threading.Thread(target=load_images, daemon=True) for _ in range(num_loaders)]
+    writer = threading.Thread(target=write_all_masks, daemon=True)
+    for thread in [*loaders, writer]:
+        thread.start()
+
+    finished_loaders = 0
+    while finished_loaders < num_loaders:
+        item = image_queue.get()
+        if item is None:
+            finished_loaders += 1
+            continue
+        t, image, error = item
+        if image is None:
+            report(t, False, error)
+            continue
+        print(f"Processing '{t}'...")
+        try:
+            masks = generator.generate(image)
+        except Exception as e:
+            report(t, False, repr(e))
+            continue
+        del image
+        write_queue.put((t, masks), masks_nbytes(masks))
+        del masks
+
+    write_queue.put(None)
+    writer.join()
+
+
+def build_generator(sam: Sam, args: argparse.Namespace) -> SamAutomaticMaskGenerator:
+    amg_kwargs = get_amg_kwargs(args)
+    if args.mask_archive is not None:
+        # Keep the masks packed as RLEs until they are written
+        generator = SamAutomaticMaskGenerator(
+            sam, output_mode="uncompressed_rle", lazy_output=True, **amg_kwargs
+        )
+    else:
+        output_mode = "coco_rle" if args.convert_to_rle else "binary_mask"
+        generator = SamAutomaticMaskGenerator(sam, output_mode=output_mode, **amg_kwargs)
+    if args.shared_feature_cache is not None:
+        shared_cache_kwargs = {}
+        if args.shared_feature_cache_max_bytes is not None:
+            shared_cache_kwargs["max_shared_bytes"] = args.shared_feature_cache_max_bytes
+        generator.feature_cache = SharedMemoryFeatureCache(
+            name=args.shared_feature_cache, **shared_cache_kwargs
+        )
+    return generator
+
+
+def worker_main(
+    sam: Sam,
+    args: argparse.Namespace,
+    num_threads: int,
+    task_queue: "mp.Queue[Optional[str]]",
+    result_queue: "mp.Queue[Any]",
+) -> None:
+    torch.set_num_threads(num_threads)
+    # Moving to the CPU keeps the shared weights, other devices get a copy
+    _ = sam.to(device=args.device)
+    generator = build_generator(sam, args)
+
+    def report(t: str, processed: bool, error: Optional[str]) -> None:
+        result_queue.put((t, processed, error))
+
+    run_pipeline(generator, iter(task_queue.get, None), args, report)
+
+
+def get_result(result_queue: "mp.Queue[Any]", workers: Sequence[BaseProcess]) -> Any:
+    """
+    Waits for the next result from the workers. Raises a RuntimeError if a worker
+    has died, as it will never report the images it held, or if every worker has
+    exited while results are still expected.
+    """
+    all_exited = False
+    while True:
+        try:
+            return result_queue.get(timeout=WORKER_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+        failed = [w for w in workers if w.exitcode not in (None, 0)]
+        if failed:
+            for w in workers:
+                if w.is_alive():
+                    w.terminate()
+            raise RuntimeError(
+                f"Worker process {failed[0].pid} exited with code {failed[0].exitcode}."
+            )
+        # Results posted just before the last worker exited are read by one more poll
+        if all_exited:
+            raise RuntimeError("All worker processes exited before reporting every image.")
+        all_exited = all(w.exitcode is not None for w in workers)
+
+
+def run_workers(sam: Sam, targets: List[str], args: argparse.Namespace) -> None:
+    # Weights in shared memory are passed to spawned workers without a copy
+    sam.share_memory()
+    ctx = mp.get_context("spawn")
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for t in targets:
+        task_queue.put(t)
+    for _ in range(args.workers):
+        task_queue.put(None)
+
+    num_threads = max(1, torch.get_num_threads() // args.workers)
+    workers = [
+        ctx.Process(
+            target=worker_main,
+            args=(sam, args, num_threads, task_queue, result_queue),
+            daemon=True,
+        )
+        for _ in range(args.workers)
+    ]
+    for w in workers:
+        w.start()
+
+    # Aggregate progress as workers finish images
+    for i in range(len(targets)):
+        t, processed, error = get_result(result_queue, workers)
+        if error is not None:
+            print(f"Failed to process '{t}': {error}")
+        status = "Processed" if processed else "Skipped"
+        print(f"[{i + 1}/{len(targets)}] {status} '{t}'")
+    for w in workers:
+        w.join()
+
+
 def main(args: argparse.Namespace) -> None:
     print("Loading model...")
     sam = sam_model_registry[args.model_type](checkpoint=args.checkpoint)
-    _ = sam.to(device=args.device)
-    output_mode = "coco_rle" if args.convert_to_rle else "binary_mask"
-    amg_kwargs = get_amg_kwargs(args)
-    generator = SamAutomaticMaskGenerator(sam, output_mode=output_mode, **amg_kwargs)
-
-    if not os.path.isdir(args.input):
-        targets = [args.input]
-    else:
-        targets = [
-            f for f in os.listdir(args.input) if not os.path.isdir(os.path.join(args.input, f))
-        ]
-        targets = [os.path.join(args.input, f) for f in targets]
+    targets = get_targets(args.input)
 
     os.makedirs(args.output, exist_ok=True)
 
-    for t in targets:
-        print(f"Processing '{t}'...")
-        image = cv2.imread(t)
-        if image is None:
-            print(f"Could not load '{t}' as an image, skipping...")
-            continue
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if args.workers > 1:
+        run_workers(sam, targets, args)
+        print("Done!")
+        return
+
+    _ = sam.to(device=args.device)
+    generator = build_generator(sam, args)
 
-        masks = generator.generate(image)
+    def report(t: str, processed: bool, error: Optional[str]) -> None:
+        if error is not None:
+            print(f"Failed to process '{t}': {error}")
 
-        base = os.path.basename(t)
-        base = os.path.splitext(base)[0]
-        save_base = os.path.join(args.output, base)
-        if output_mode == "binary_mask":
-            os.makedirs(save_base, exist_ok=False)
-            write_masks_to_folder(masks, save_base)
-        else:
-            save_file = save_base + ".json"
-            with open(save_file, "w") as f:
-                json.dump(masks, f)
+    run_pipeline(generator, targets, args, report)
     print("Done!")
 
 
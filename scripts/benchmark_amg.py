@@ -0,0 +1,375 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import segment_anything.automatic_mask_generator as amg_module
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.build_sam import _build_sam
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Benchmarks automatic mask generation with randomly initialized SAM models on "
+        "synthetic images, so that no checkpoint is needed. Reports the time and peak "
+        "memory of each stage of mask generation to a json file."
+    )
+)
+
+parser.add_argument(
+    "--output",
+    type=str,
+    required=True,
+    help="Path to the json file the results are written to.",
+)
+
+parser.add_argument(
+    "--model-configs",
+    type=str,
+    nargs="+",
+    default=["tiny", "small"],
+    help=(
+        "The model configs to benchmark, from ['tiny', 'small', 'vit_b', 'vit_l', 'vit_h']. "
+        "'tiny' and 'small' have a few narrow encoder layers, the others are the real SAM "
+        "configs with random weights."
+    ),
+)
+
+parser.add_argument(
+    "--image-sizes",
+    type=str,
+    nargs="+",
+    default=["512x512", "1024x768", "1920x1080"],
+    help="The sizes of the synthetic images, given as WIDTHxHEIGHT.",
+)
+
+parser.add_argument("--device", type=str, default="cpu", help="The device to run on.")
+
+parser.add_argument(
+    "--repeats",
+    type=int,
+    default=3,
+    help="The number of timed runs for each model config and image size.",
+)
+
+parser.add_argument(
+    "--warmup",
+    type=int,
+    default=1,
+    help="The number of untimed runs before the timed ones.",
+)
+
+parser.add_argument(
+    "--amg-kwargs",
+    type=str,
+    default="{}",
+    help=(
+        "A json dict of SamAutomaticMaskGenerator arguments, which override the defaults "
+        "of this benchmark. The defaults keep every mask, since random weights give masks "
+        "with low quality scores."
+    ),
+)
+
+parser.add_argument("--seed", type=int, default=0, help="The seed for weights and images.")
+
+MODEL_CONFIGS: Dict[str, Dict[str, Any]] = {
+    "tiny": dict(
+        encoder_embed_dim=64,
+        encoder_depth=2,
+        encoder_num_heads=2,
+        encoder_global_attn_indexes=[1],
+    ),
+    "small": dict(
+        encoder_embed_dim=192,
+        encoder_depth=4,
+        encoder_num_heads=3,
+        encoder_global_attn_indexes=[1, 3],
+    ),
+    "vit_b": dict(
+        encoder_embed_dim=768,
+        encoder_depth=12,
+        encoder_num_heads=12,
+        encoder_global_attn_indexes=[2, 5, 8, 11],
+    ),
+    "vit_l": dict(
+        encoder_embed_dim=1024,
+        encoder_depth=24,
+        encoder_num_heads=16,
+        encoder_global_attn_indexes=[5, 11, 17, 23],
+    ),
+    "vit_h": dict(
+        encoder_embed_dim=1280,
+        encoder_depth=32,
+        encoder_num_heads=16,
+        encoder_global_attn_indexes=[7, 15, 23, 31],
+    ),
+}
+
+DEFAULT_AMG_KWARGS: Dict[str, Any] = dict(
+    points_per_side=16,
+    pred_iou_thresh=0.0,
+    stability_score_thresh=0.0,
+)
+
+
+def read_rss() -> Optional[int]:
+    """Returns the resident memory of this process in bytes, if it can be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class _OpenStage:
+    __slots__ = ("name", "start", "start_rss", "child_time", "start_cuda", "peak_cuda")
+
+    def __init__(self, name: str, start_rss: int, start_cuda: int) -> None:
+        self.name = name
+        self.start = time.perf_counter()
+        self.start_rss = start_rss
+        self.child_time = 0.0
+        self.start_cuda = start_cuda
+        self.peak_cuda = start_cuda
+
+
+class StageProfiler:
+    """
+    Accumulates the wall time and peak memory of nested stages, which must all run
+    on one thread. Peak memory is the largest increase in resident memory over the
+    start of a stage, found by sampling from a background thread, and the same for
+    allocated memory on CUDA devices.
+    """
+
+    def __init__(self, device: torch.device, sample_interval: float = 0.001) -> None:
+        self.device = device
+        self.sample_interval = sample_interval
+        self.times: Dict[str, float] = defaultdict(float)
+        self.self_times: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.peak_rss: Dict[str, int] = {}
+        self.peak_cuda: Dict[str, int] = {}
+        self._stack: List[_OpenStage] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "StageProfiler":
+        if read_rss() is not None:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.sample_interval):
+            self._record_rss()
+
+    def _record_rss(self) -> None:
+        rss = read_rss()
+        if rss is None:
+            return
+        with self._lock:
+            for stage in self._stack:
+                peak = max(self.peak_rss.get(stage.name, 0), rss - stage.start_rss)
+                self.peak_rss[stage.name] = peak
+
+    def _record_cuda(self) -> None:
+        # The peak is reset at the start of each stage, so fold it into the open
+        # stages first
+        peak = torch.cuda.max_memory_allocated(self.device)
+        for stage in self._stack:
+            stage.peak_cuda = max(stage.peak_cuda, peak)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        use_cuda = self.device.type == "cuda"
+        start_cuda = 0
+        if use_cuda:
+            torch.cuda.synchronize(self.device)
+            self._record_cuda()
+            torch.cuda.reset_peak_memory_stats(self.device)
+            start_cuda = torch.cuda.memory_allocated(self.device)
+        with self._lock:
+            self._stack.append(_OpenStage(name, read_rss() or 0, start_cuda))
+        try:
+            yield
+        finally:
+            if use_cuda:
+                torch.cuda.synchronize(self.device)
+                self._record_cuda()
+            self._record_rss()
+            with self._lock:
+                stage = self._stack.pop()
+                elapsed = time.perf_counter() - stage.start
+                self.times[name] += elapsed
+                self.self_times[name] += elapsed - stage.child_time
+                self.calls[name] += 1
+                if self._stack:
+                    self._stack[-1].child_time += elapsed
+            if use_cuda:
+                peak = stage.peak_cuda - stage.start_cuda
+                self.peak_cuda[name] = max(self.peak_cuda.get(name, 0), peak)
+
+    def wrap(self, name: str, fn: Callable) -> Callable:
+        def wrapped(*args: Any, **kwargs: Any) -> Any:
+            with self.stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapped
+
+    def results(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {
+                "time_s": self.times[name],
+                "self_time_s": self.self_times[name],
+                "calls": self.calls[name],
+                "peak_rss_bytes": self.peak_rss.get(name),
+                "peak_cuda_bytes": self.peak_cuda.get(name),
+            }
+            for name in self.times
+        }
+
+
+@contextmanager
+def profiled_generator(
+    generator: SamAutomaticMaskGenerator, profiler: StageProfiler
+) -> Iterator[None]:
+    """
+    Times the stages of a mask generator by wrapping the functions that run them.
+    The self time of filtering is the time spent post-processing decoded masks,
+    less RLE encoding and NMS.
+    """
+    model = generator.predictor.model
+    instance_patches: List[Tuple[Any, str, str]] = [
+        (model.image_encoder, "forward", "encoder"),
+        (generator.predictor, "predict_low_res_torch", "decoder"),
+        (generator, "_postprocess_batch", "filtering"),
+        (generator, "_mask_data_to_annotations", "output_encoding"),
+    ]
+    module_patches: List[Tuple[str, str]] = [
+        ("mask_to_rle_counts_pytorch", "rle_encoding"),
+        ("window_mask_to_rle_counts_pytorch", "rle_encoding"),
+        ("batched_nms", "nms"),
+    ]
+    originals = [getattr(amg_module, attr) for attr, _ in module_patches]
+    for obj, attr, name in instance_patches:
+        setattr(obj, attr, profiler.wrap(name, getattr(obj, attr)))
+    for (attr, name), fn in zip(module_patches, originals):
+        setattr(amg_module, attr, profiler.wrap(name, fn))
+    try:
+        yield
+    finally:
+        for obj, attr, _ in instance_patches:
+            delattr(obj, attr)
+        for (attr, _), fn in zip(module_patches, originals):
+            setattr(amg_module, attr, fn)
+
+
+def synthetic_image(width: int, height: int, seed: int) -> np.ndarray:
+    """Makes an HWC uint8 image of smooth random blobs."""
+    rng = np.random.default_rng(seed)
+    coarse = rng.random((max(height // 64, 2), max(width // 64, 2), 3))
+    rows = np.linspace(0, coarse.shape[0] - 1, height).round().astype(int)
+    cols = np.linspace(0, coarse.shape[1] - 1, width).round().astype(int)
+    image = coarse[rows][:, cols] * 200 + rng.random((height, width, 3)) * 55
+    return image.astype(np.uint8)
+
+
+def parse_size(size: str) -> Tuple[int, int]:
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(
+    model_config: str, size: Tuple[int, int], args: argparse.Namespace
+) -> List[Dict[str, Any]]:
+    torch.manual_seed(args.seed)
+    sam = _build_sam(**MODEL_CONFIGS[model_config])
+    _ = sam.to(device=args.device)
+    amg_kwargs = {**DEFAULT_AMG_KWARGS, **json.loads(args.amg_kwargs)}
+    # Stages are timed on the calling thread
+    amg_kwargs["pipelined_postprocessing"] = False
+    generator = SamAutomaticMaskGenerator(sam, **amg_kwargs)
+    image = synthetic_image(*size, seed=args.seed)
+
+    for _ in range(args.warmup):
+        generator.generate(image)
+
+    results = []
+    for repeat in range(args.repeats):
+        profiler = StageProfiler(torch.device(args.device))
+        with profiler, profiled_generator(generator, profiler):
+            with profiler.stage("total"):
+                masks = generator.generate(image)
+        results.append(
+            {
+                "model_config": model_config,
+                "image_size": list(size),
+                "repeat": repeat,
+                "num_masks": len(masks),
+                "amg_kwargs": amg_kwargs,
+                "stages": profiler.results(),
+            }
+        )
+        print(
+            f"{model_config} {size[0]}x{size[1]} run {repeat}: "
+            f"{profiler.times['total']:.3f}s, {len(masks)} masks"
+        )
+    return results
+
+
+def main(args: argparse.Namespace) -> None:
+    for model_config in args.model_configs:
+        assert model_config in MODEL_CONFIGS, f"Unknown model config {model_config}."
+    results = []
+    for model_config in args.model_configs:
+        for size in args.image_sizes:
+            results.extend(run_benchmark(model_config, parse_size(size), args))
+
+    report = {
+        "commit": git_commit(),
+        "torch_version": torch.__version__,
+        "platform": platform.platform(),
+        "device": args.device,
+        "num_threads": torch.get_num_threads(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote results to '{args.output}'.")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -8,34 +8,52 @@ import numpy as np
 import torch
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
-from typing import Any, Dict, List, Optional, Tuple
+import copy
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Generator, List, Optional, Sequence, Tuple, Union
 
 from .modeling import Sam
 from .predictor import SamPredictor
+from .utils.annotations import MaskAnnotations, MaskStreamChunk
+from .utils.decoder_outputs import CropDecoderOutputs, DecoderOutputs
+from .utils.stats import GenerationStats, crop_timer, stage_timer
 from .utils.amg import (
     MaskData,
-    area_from_rle,
+    PackedRLEs,
     batch_iterator,
     batched_mask_to_box,
     box_xyxy_to_xywh,
     build_all_layer_point_grids,
     calculate_stability_score,
+    coarse_to_fine_order,
     coco_encode_rle,
     generate_crop_boxes,
     is_box_near_crop_edge,
-    mask_to_rle_pytorch,
-    remove_small_regions,
-    rle_to_mask,
-    rle_to_mask_torch,
+    is_out_of_memory_error,
+    mask_to_rle_counts_pytorch,
+    mask_upsampling_matrix,
+    remove_small_regions_in_box,
+    rle_counts_to_window,
+    rles_to_masks,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
-    sample_image,
-    FeatureCache, filter_crop_boxes_by_area,
+    upsample_mask_window,
+    window_mask_to_rle_counts_pytorch,
+    window_to_box,
+    FeatureCache,
+    FeatureSpec,
+    SummedAreaTable,
+    filter_crop_boxes_by_area,
 )
 
 
 class SamAutomaticMaskGenerator:
+    # The number of decoded batches that may wait for post-processing
+    _max_pending_batches = 2
+
     def __init__(
         self,
         model: Sam,
@@ -56,7 +74,19 @@ class SamAutomaticMaskGenerator:
         output_mode: str = "binary_mask",
         min_local_score_thresh_for_crop_skip: Optional[float] = None,
         min_local_score_thresh_for_point_skip: Optional[float] = None,
+        min_local_score_thresh_for_mask_skip: Optional[float] = None,
         feature_cache_size: Optional[int] = None,
+        feature_cache_max_bytes: Optional[int] = None,
+        feature_cache_dir: Optional[str] = None,
+        feature_cache_max_disk_bytes: Optional[int] = None,
+        encoder_batch_size: int = 1,
+        low_res_filtering: bool = False,
+        windowed_upsampling: bool = False,
+        lazy_output: bool = False,
+        adaptive_point_sampling: bool = False,
+        adaptive_sampling_iou_thresh: float = 0.95,
+        pipelined_postprocessing: bool = False,
+        memory_budget_bytes: Optional[int] = None,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -109,11 +139,69 @@ class SamAutomaticMaskGenerator:
             skipped if the mean local bias over the crop is below this threshold.
           min_local_score_thresh_for_point_skip (float or None): If >0, points will be
             skipped if the local bias at the point is below this threshold.
+          min_local_score_thresh_for_mask_skip (float or None): If not None,
+            masks will be dropped before they are encoded if the mean local bias
+            over their box is below this threshold.
           feature_cache_size (int or None): If not None, the feature cache will be
             used to store features for each image and crop. This can speed up
             inference if the same image and crop is used multiple times. The cache
             will store up to feature_cache_size images. If None, the cache will not
             be used.
+          feature_cache_max_bytes (int or None): If not None, the feature cache
+            is used and holds at most this many bytes of features on each
+            device, evicting the least recently used features first.
+          feature_cache_dir (str or None): If not None, the feature cache is
+            used and also keeps features in files in this directory, so they
+            persist across runs and processes. Without feature_cache_size,
+            features are then only kept on disk.
+          feature_cache_max_disk_bytes (int or None): If not None, the least
+            recently used files in feature_cache_dir are deleted when they
+            take more than this many bytes.
+          encoder_batch_size (int): Sets the number of image crops run
+            simultaneously by the image encoder. If >1, the crops that are not
+            skipped are resized, padded and encoded in batches of this size, and
+            masks are then decoded from each crop's slice of the batched
+            embeddings. Higher numbers may be faster but use more GPU memory.
+          low_res_filtering (bool): If True, the stability score and the crop
+            edge filter are computed on the model's 256x256 low resolution mask
+            logits, so that only masks passing both are upsampled. This is much
+            cheaper for large images, but the stability score is approximate.
+            The low resolution edge filter only drops masks that are near a
+            crop edge by a margin of one low resolution pixel, and leaves the
+            rest to the full resolution check. Masks are always filtered by
+            predicted IoU before upsampling.
+          windowed_upsampling (bool): If True, each mask is only upsampled within
+            the window around it, found from the low resolution logits, and is
+            kept as that window plus an offset until it is run length encoded.
+            Peak memory then grows with the mask area instead of the image area.
+            Masks match the full upsampling up to floating point rounding.
+          lazy_output (bool): If True, 'generate' returns a MaskAnnotations
+            collection instead of a list of dicts. Its records are read from
+            columnar arrays and masks are only decoded to output_mode when a
+            segmentation is accessed, so the collection can be filtered by
+            area, scores or box before any mask is decoded.
+          adaptive_point_sampling (bool): If True, the points of each crop are
+            run from a coarse subgrid to the full grid, and points that fall
+            inside a confident mask from an earlier batch are dropped before
+            they reach the model. This saves most of the decoding work on
+            images with a few large objects, but may miss small masks inside
+            larger ones.
+          adaptive_sampling_iou_thresh (float): A mask that passes all filters
+            is confident, and covers points for adaptive_point_sampling, if
+            its predicted IoU is at least this threshold.
+          pipelined_postprocessing (bool): If True, the filtering, upsampling
+            and RLE encoding of each batch of points run on a worker thread
+            while the model decodes the next batches. At most two decoded
+            batches wait for the worker. Masks are the same as without it.
+            Ignored with adaptive_point_sampling, where each batch depends on
+            the masks of the previous ones.
+          memory_budget_bytes (int or None): If not None, points_per_batch is
+            ignored and the number of points run simultaneously is chosen for
+            each crop, so that the estimated memory for decoding and
+            post-processing a batch, which grows with the crop's size, fits in
+            this many bytes. If an allocation fails anyway, the crop is rerun
+            with half as many points per batch. Later crops are sized from
+            the estimate again.
         """
 
         assert (points_per_side is None) != (
@@ -130,6 +218,11 @@ class SamAutomaticMaskGenerator:
         else:
             raise ValueError("Can't have both points_per_side and point_grid be None.")
 
+        assert encoder_batch_size > 0, "encoder_batch_size must be positive."
+        assert (
+            memory_budget_bytes is None or memory_budget_bytes > 0
+        ), "memory_budget_bytes must be positive."
+
         assert output_mode in [
             "binary_mask",
             "uncompressed_rle",
@@ -159,10 +252,32 @@ class SamAutomaticMaskGenerator:
         self.min_local_score_thresh_for_point_skip = (
             min_local_score_thresh_for_point_skip
         )
+        self.min_local_score_thresh_for_mask_skip = min_local_score_thresh_for_mask_skip
         self.feature_cache_size = feature_cache_size
+        self.feature_cache_max_bytes = feature_cache_max_bytes
+        self.feature_cache_dir = feature_cache_dir
+        self.feature_cache_max_disk_bytes = feature_cache_max_disk_bytes
+        self.encoder_batch_size = encoder_batch_size
+        self.low_res_filtering = low_res_filtering
+        self.windowed_upsampling = windowed_upsampling
+        self.lazy_output = lazy_output
+        self.adaptive_point_sampling = adaptive_point_sampling
+        self.adaptive_sampling_iou_thresh = adaptive_sampling_iou_thresh
+        self.pipelined_postprocessing = pipelined_postprocessing
+        self.memory_budget_bytes = memory_budget_bytes
         # Init the cache
+        cache_kwargs: Dict[str, Any] = {}
         if feature_cache_size is not None and feature_cache_size > 0:
-            self.feature_cache = FeatureCache(max_cache_size=feature_cache_size)
+            cache_kwargs["max_cache_size"] = feature_cache_size
+        elif feature_cache_dir is not None and feature_cache_max_bytes is None:
+            cache_kwargs["max_cache_size"] = 0
+        if feature_cache_max_bytes is not None:
+            cache_kwargs["max_cache_bytes"] = feature_cache_max_bytes
+        if feature_cache_dir is not None:
+            cache_kwargs["disk_cache_dir"] = feature_cache_dir
+            cache_kwargs["max_disk_bytes"] = feature_cache_max_disk_bytes
+        if len(cache_kwargs) > 0:
+            self.feature_cache: Optional[FeatureCache] = FeatureCache(**cache_kwargs)
         else:
             self.feature_cache = None
 
@@ -172,7 +287,8 @@ class SamAutomaticMaskGenerator:
         image: np.ndarray,
         local_score_bias: Optional[np.ndarray] = None,
         feature_cache: Optional[FeatureCache] = None,
-    ) -> List[Dict[str, Any]]:
+        stats: Optional[GenerationStats] = None,
+    ) -> Union[List[Dict[str, Any]], MaskAnnotations]:
         """
         Generates masks for the given image.
 
@@ -183,7 +299,10 @@ class SamAutomaticMaskGenerator:
           feature_cache (FeatureCache): A cache of features for the image. If provided,
             the model will not recompute features for the image if it's found in the cache.
             If not provided, the internal feature cache will be used, if defined. If no
-            internal feature cache is defined, features will be recomputed.
+            internal feature cache is defined, features will be recomputed. A
+            SharedMemoryFeatureCache shares features between processes.
+          stats (GenerationStats): If provided, the counts at each filter and
+            the time of each stage and crop are added to it.
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
@@ -201,22 +320,308 @@ class SamAutomaticMaskGenerator:
                  is filtered on using the stability_score_thresh parameter.
                crop_box (list(float)): The crop of the image used to generate
                  the mask, given in XYWH format.
+             If lazy_output is True, a MaskAnnotations collection over the
+             same records is returned instead.
+        """
+
+        with stage_timer(stats, "total"):
+            # Generate masks
+            mask_data = self._generate_masks(
+                image,
+                local_score_bias=local_score_bias,
+                feature_cache=self._get_feature_cache(feature_cache),
+                stats=stats,
+            )
+            return self._mask_data_to_annotations(mask_data, stats)
+
+    @torch.no_grad()
+    def generate_batch(
+        self,
+        images: List[np.ndarray],
+        local_score_biases: Optional[List[Optional[np.ndarray]]] = None,
+        feature_cache: Optional[FeatureCache] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> List[Union[List[Dict[str, Any]], MaskAnnotations]]:
+        """
+        Generates masks for several images. The crops of all images are run
+        through the image encoder in shared batches of encoder_batch_size,
+        while prompt decoding and filtering are done per image. The masks
+        of each image are the same as those returned by 'generate'.
+
+        Arguments:
+          images (list(np.ndarray)): The images to generate masks for, each
+            in HWC uint8 format.
+          local_score_biases (list(np.ndarray or None) or None): The local
+            score bias of each image, as for 'generate'.
+          feature_cache (FeatureCache): A cache of features for the images,
+            as for 'generate'.
+          stats (GenerationStats): If provided, the stats of all images are
+            added to it, as for 'generate'.
+
+        Returns:
+           list(list(dict(str, any))): A list over images, holding the mask
+             records of each image in the format returned by 'generate'.
+        """
+        if local_score_biases is None:
+            local_score_biases = [None] * len(images)
+        assert len(local_score_biases) == len(
+            images
+        ), "local_score_biases must have one entry per image."
+
+        with stage_timer(stats, "total"):
+            # Generate masks
+            mask_datas = self._generate_masks_batch(
+                images,
+                local_score_biases=local_score_biases,
+                feature_cache=self._get_feature_cache(feature_cache),
+                stats=stats,
+            )
+            return [
+                self._mask_data_to_annotations(data, stats) for data in mask_datas
+            ]
+
+    @torch.no_grad()
+    def generate_iter(
+        self,
+        image: np.ndarray,
+        local_score_bias: Optional[np.ndarray] = None,
+        feature_cache: Optional[FeatureCache] = None,
+        reconcile_crops: bool = True,
+        stats: Optional[GenerationStats] = None,
+    ) -> Generator[MaskStreamChunk, None, None]:
+        """
+        Generates masks for the given image, yielding the masks of each crop
+        as soon as that crop is processed. Masks are de-duplicated within
+        their crop, but not yet between crops. Only the boxes of the yielded
+        masks are kept, so that memory does not grow with the number of crops.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          local_score_bias (np.ndarray): Extra bias for the IOU scores, as for
+            'generate'.
+          feature_cache (FeatureCache): A cache of features for the image, as
+            for 'generate'.
+          reconcile_crops (bool): If True and the image has more than one crop,
+            NMS between crops is run once all crops are processed, and a final
+            chunk gives the ids of the masks it suppresses. The masks left are
+            then those returned by 'generate', except that small region
+            postprocessing, if enabled, is applied to each crop separately.
+          stats (GenerationStats): If provided, stats are added to it as for
+            'generate'. The total time leaves out the time between chunks.
+
+        Returns:
+          (MaskStreamChunk): Chunks holding the mask records of one crop in the
+            format returned by 'generate', with ids numbering the masks in the
+            order they are yielded, followed by an optional chunk holding the
+            ids of the masks suppressed between crops.
+        """
+        feature_cache = self._get_feature_cache(feature_cache)
+        n_crops = 0
+        next_id = 0
+        boxes, crop_boxes = [], []
+        start = time.perf_counter()
+        for _, crop_box, n_crops, crop_data in self._iter_crop_masks(
+            [image], [local_score_bias], feature_cache, stats
+        ):
+            crop_data.to_numpy()
+            annotations = self._mask_data_to_annotations(crop_data, stats)
+            boxes.append(crop_data["boxes"])
+            crop_boxes.append(crop_data["crop_boxes"])
+            ids = list(range(next_id, next_id + len(annotations)))
+            next_id += len(annotations)
+            if stats is not None:
+                stats.add_time("total", time.perf_counter() - start)
+            yield MaskStreamChunk(
+                crop_box=_crop_box_xywh(crop_box),
+                ids=ids,
+                annotations=annotations,
+            )
+            start = time.perf_counter()
+
+        # Remove duplicate masks between crops
+        if reconcile_crops and n_crops > 1 and next_id > 0:
+            keep_by_nms = self._crop_nms(
+                torch.as_tensor(np.concatenate(boxes)),
+                torch.as_tensor(np.concatenate(crop_boxes)),
+                stats,
+            )
+            suppressed = np.ones(next_id, dtype=bool)
+            suppressed[keep_by_nms.cpu().numpy()] = False
+            if stats is not None:
+                stats.add("masks_dropped_by_crop_nms", int(suppressed.sum()))
+                stats.add_time("total", time.perf_counter() - start)
+            yield MaskStreamChunk(suppressed_ids=np.flatnonzero(suppressed).tolist())
+        elif stats is not None:
+            stats.add_time("total", time.perf_counter() - start)
+
+    @torch.no_grad()
+    def generate_decoder_outputs(
+        self,
+        image: np.ndarray,
+        local_score_bias: Optional[np.ndarray] = None,
+        feature_cache: Optional[FeatureCache] = None,
+        min_pred_iou_thresh: float = 0.0,
+        logits_dtype: torch.dtype = torch.float16,
+        stats: Optional[GenerationStats] = None,
+    ) -> DecoderOutputs:
         """
+        Runs the image encoder and mask decoder on the crops and points of the
+        image as 'generate' does, but keeps the raw decoder outputs instead of
+        filtering them. 'refilter' then gives the masks for other thresholds
+        without running the model again. Crops and points are skipped on the
+        local score bias here, and adaptive_point_sampling is ignored.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          local_score_bias (np.ndarray): Extra bias for the IOU scores, as for
+            'generate'.
+          feature_cache (FeatureCache): A cache of features for the image, as
+            for 'generate'.
+          min_pred_iou_thresh (float): If >0, masks whose predicted IoU is not
+            over this threshold are not kept, which saves memory when lower
+            values of pred_iou_thresh will not be tried.
+          logits_dtype (torch.dtype): The dtype the low resolution logits are
+            kept in. float16 halves their memory but rounds them, which may
+            change a few pixels and scores of the masks. With torch.float32,
+            'refilter' gives the masks 'generate' would.
+          stats (GenerationStats): If provided, the counts up to the decoder
+            and the time of each stage and crop are added to it.
 
-        # Generate masks
-        mask_data = self._generate_masks(
-            image,
-            local_score_bias=local_score_bias,
-            feature_cache=(feature_cache or self.feature_cache),
+        Returns:
+          (DecoderOutputs): The decoder outputs of each crop, on the CPU.
+        """
+        feature_cache = self._get_feature_cache(feature_cache)
+        outputs = DecoderOutputs(
+            orig_size=(image.shape[0], image.shape[1]),
+            n_crops=len(self._get_crop_boxes(image.shape[:2])[0]),
+            min_pred_iou_thresh=min_pred_iou_thresh,
         )
+        with stage_timer(stats, "total"):
+            crops = self._iter_crops([image], [local_score_bias], feature_cache, stats)
+            for _, crop_box, _, points_for_image, features, cache_key, _ in crops:
+                with crop_timer(
+                    stats, 0, _crop_box_xywh(crop_box), len(points_for_image)
+                ):
+                    crop_outputs = self._decode_crop(
+                        image=image,
+                        crop_box=crop_box,
+                        points_for_image=points_for_image,
+                        orig_size=image.shape[:2],
+                        feature_cache=feature_cache,
+                        cache_key=cache_key,
+                        crop_features=features,
+                        min_pred_iou_thresh=min_pred_iou_thresh,
+                        logits_dtype=logits_dtype,
+                        stats=stats,
+                    )
+                outputs.crops.append(crop_outputs)
+        return outputs
+
+    @torch.no_grad()
+    def refilter(
+        self,
+        outputs: DecoderOutputs,
+        pred_iou_thresh: Optional[float] = None,
+        stability_score_thresh: Optional[float] = None,
+        box_nms_thresh: Optional[float] = None,
+        crop_nms_thresh: Optional[float] = None,
+        local_score_bias: Optional[np.ndarray] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> Union[List[Dict[str, Any]], MaskAnnotations]:
+        """
+        Filters the decoder outputs kept by 'generate_decoder_outputs', and
+        runs NMS and output encoding on the masks left, as 'generate' does
+        after running the model. This generator is not changed.
+
+        Arguments:
+          outputs (DecoderOutputs): The decoder outputs for an image.
+          pred_iou_thresh (float or None): If not None, replaces the generator's
+            pred_iou_thresh. It may not be below the min_pred_iou_thresh the
+            outputs were kept with.
+          stability_score_thresh (float or None): If not None, replaces the
+            generator's stability_score_thresh.
+          box_nms_thresh (float or None): If not None, replaces the generator's
+            box_nms_thresh.
+          crop_nms_thresh (float or None): If not None, replaces the generator's
+            crop_nms_thresh.
+          local_score_bias (np.ndarray): Extra bias for the IOU scores, as for
+            'generate'. Only used to skip masks, since crops and points were
+            skipped when the outputs were kept.
+          stats (GenerationStats): If provided, the counts at each filter and
+            the time of each stage are added to it.
+
+        Returns:
+          (list(dict(str, any)) or MaskAnnotations): The mask records, in the
+            format returned by 'generate'.
+        """
+        thresholds = {
+            "pred_iou_thresh": pred_iou_thresh,
+            "stability_score_thresh": stability_score_thresh,
+            "box_nms_thresh": box_nms_thresh,
+            "crop_nms_thresh": crop_nms_thresh,
+        }
+        generator = copy.copy(self)
+        # Post-processing sets each crop's sizes on the predictor, so the copy
+        # gets its own predictor that shares the model
+        generator.predictor = copy.copy(self.predictor)
+        for name, value in thresholds.items():
+            if value is not None:
+                setattr(generator, name, value)
+        assert (
+            generator.pred_iou_thresh >= outputs.min_pred_iou_thresh
+        ), "pred_iou_thresh is below the min_pred_iou_thresh of the outputs."
+
+        with stage_timer(stats, "total"):
+            mask_score_table = None
+            if (
+                local_score_bias is not None
+                and generator.min_local_score_thresh_for_mask_skip is not None
+            ):
+                mask_score_table = SummedAreaTable(local_score_bias)
+            data = MaskData()
+            for crop_outputs in outputs.crops:
+                data.cat(
+                    generator._refilter_crop(
+                        crop_outputs, outputs.orig_size, mask_score_table, stats
+                    )
+                )
+            generator._finish_image(data, outputs.n_crops, stats)
+            return generator._mask_data_to_annotations(data, stats)
+
+    def _get_feature_cache(
+        self, feature_cache: Optional[FeatureCache]
+    ) -> Optional[FeatureCache]:
+        # An empty cache is falsy, so it is compared to None
+        return feature_cache if feature_cache is not None else self.feature_cache
 
+    def _mask_data_to_annotations(
+        self, mask_data: MaskData, stats: Optional[GenerationStats] = None
+    ) -> Union[List[Dict[str, Any]], MaskAnnotations]:
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
-            mask_data = self.postprocess_small_regions(
-                mask_data,
-                self.min_mask_region_area,
-                max(self.box_nms_thresh, self.crop_nms_thresh),
-            )
+            n_masks = len(mask_data["rles"])
+            with stage_timer(stats, "small_regions"):
+                mask_data = self.postprocess_small_regions(
+                    mask_data,
+                    self.min_mask_region_area,
+                    max(self.box_nms_thresh, self.crop_nms_thresh),
+                )
+            if stats is not None:
+                stats.add(
+                    "masks_dropped_by_small_region_nms",
+                    n_masks - len(mask_data["rles"]),
+                )
+        if stats is not None:
+            stats.add("masks", len(mask_data["rles"]))
+
+        with stage_timer(stats, "output_encoding"):
+            return self._encode_annotations(mask_data)
+
+    def _encode_annotations(
+        self, mask_data: MaskData
+    ) -> Union[List[Dict[str, Any]], MaskAnnotations]:
+        if self.lazy_output:
+            return MaskAnnotations.from_mask_data(mask_data, self.output_mode)
 
         # Encode masks
         if self.output_mode == "coco_rle":
@@ -224,16 +629,17 @@ class SamAutomaticMaskGenerator:
                 coco_encode_rle(rle) for rle in mask_data["rles"]
             ]
         elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+            mask_data["segmentations"] = list(rles_to_masks(mask_data["rles"]))
         else:
-            mask_data["segmentations"] = mask_data["rles"]
+            mask_data["segmentations"] = mask_data["rles"].to_dicts()
+        areas = mask_data["rles"].areas().tolist()
 
         # Write mask records
         curr_anns = []
         for idx in range(len(mask_data["segmentations"])):
             ann = {
                 "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
+                "area": areas[idx],
                 "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
                 "predicted_iou": mask_data["iou_preds"][idx].item(),
                 "point_coords": [mask_data["points"][idx].tolist()],
@@ -249,139 +655,754 @@ class SamAutomaticMaskGenerator:
         image: np.ndarray,
         local_score_bias: Optional[np.ndarray] = None,
         feature_cache: Optional[FeatureCache] = None,
+        stats: Optional[GenerationStats] = None,
     ) -> MaskData:
-        orig_size = image.shape[:2]
+        return self._generate_masks_batch(
+            [image],
+            local_score_biases=[local_score_bias],
+            feature_cache=feature_cache,
+            stats=stats,
+        )[0]
+
+    def _generate_masks_batch(
+        self,
+        images: List[np.ndarray],
+        local_score_biases: List[Optional[np.ndarray]],
+        feature_cache: Optional[FeatureCache] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> List[MaskData]:
+        datas = [MaskData() for _ in images]
+        n_crops = [0] * len(images)
+        for image_idx, _, image_n_crops, crop_data in self._iter_crop_masks(
+            images, local_score_biases, feature_cache, stats
+        ):
+            n_crops[image_idx] = image_n_crops
+            datas[image_idx].cat(crop_data)
+
+        for data, image_n_crops in zip(datas, n_crops):
+            self._finish_image(data, image_n_crops, stats)
+        return datas
+
+    def _finish_image(
+        self,
+        data: MaskData,
+        n_crops: int,
+        stats: Optional[GenerationStats] = None,
+    ) -> None:
+        """
+        Removes duplicate masks between the crops of an image and moves its
+        masks to numpy. Edits data in place.
+        """
+        if n_crops > 1 and len(data) > 0:
+            keep_by_nms = self._crop_nms(data["boxes"], data["crop_boxes"], stats)
+            self._filter_data(data, keep_by_nms, stats, "masks_dropped_by_crop_nms")
+
+        data.to_numpy()
+
+    def _iter_crop_masks(
+        self,
+        images: List[np.ndarray],
+        local_score_biases: List[Optional[np.ndarray]],
+        feature_cache: Optional[FeatureCache] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> Generator[Tuple[int, List[int], int, MaskData], None, None]:
+        """
+        Yields the image index, crop box, number of crops of that image and
+        de-duplicated masks of each crop as soon as the crop is processed.
+        Crops without any points left are not processed.
+        """
+        for (
+            image_idx,
+            crop_box,
+            n_crops,
+            points_for_image,
+            features,
+            cache_key,
+            score_tables,
+        ) in self._iter_crops(images, local_score_biases, feature_cache, stats):
+            with crop_timer(
+                stats, image_idx, _crop_box_xywh(crop_box), len(points_for_image)
+            ) as record:
+                crop_data = self._process_crop(
+                    image=images[image_idx],
+                    crop_box=crop_box,
+                    points_for_image=points_for_image,
+                    orig_size=images[image_idx].shape[:2],
+                    feature_cache=feature_cache,
+                    cache_key=cache_key,
+                    crop_features=features,
+                    mask_score_table=score_tables.get("mask"),
+                    stats=stats,
+                )
+                if record is not None:
+                    record.num_masks = len(crop_data)
+            yield image_idx, crop_box, n_crops, crop_data
+
+    def _iter_crops(
+        self,
+        images: List[np.ndarray],
+        local_score_biases: List[Optional[np.ndarray]],
+        feature_cache: Optional[FeatureCache] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> Generator[
+        Tuple[
+            int,
+            List[int],
+            int,
+            np.ndarray,
+            Optional[FeatureSpec],
+            Optional[str],
+            Dict[str, SummedAreaTable],
+        ],
+        None,
+        None,
+    ]:
+        """
+        Yields the image index, crop box, number of crops of that image,
+        prompt points, features if already encoded, feature cache key and
+        local score tables of each crop that has points left. Crops are
+        encoded in batches of encoder_batch_size as they are reached.
+        """
+        # Get the points for each crop, dropping crops that have none left
+        crops = []
+        n_crops = []
+        score_tables = []
+        image_keys: List[Optional[str]] = [None] * len(images)
+        with stage_timer(stats, "setup"):
+            for image_idx, (image, local_score_bias) in enumerate(
+                zip(images, local_score_biases)
+            ):
+                # Hash each image once, and key its crops by their boxes
+                if feature_cache is not None:
+                    image_keys[image_idx] = feature_cache.image_key(image)
+                crop_boxes, layer_idxs = self._get_crop_boxes(image.shape[:2])
+                n_crops.append(len(crop_boxes))
+                score_tables.append(self._get_local_score_tables(local_score_bias))
+                # Skip crops with low local score bias, if requested
+                if "crop" in score_tables[-1]:
+                    keep_crops = score_tables[-1]["crop"].box_sums(crop_boxes) > 0
+                else:
+                    keep_crops = np.ones(len(crop_boxes), dtype=bool)
+                if stats is not None:
+                    stats.add("crops", len(crop_boxes))
+                    stats.add("crops_skipped_by_score", int((~keep_crops).sum()))
+                for crop_box, layer_idx, keep_crop in zip(
+                    crop_boxes, layer_idxs, keep_crops
+                ):
+                    if not keep_crop:
+                        continue
+                    points_for_image = self._get_crop_points(
+                        crop_box, layer_idx, local_score_bias, stats
+                    )
+                    if points_for_image.shape[0] > 0:
+                        crops.append((image_idx, crop_box, points_for_image))
+                    elif stats is not None:
+                        stats.add("crops_without_points")
+
+        # Iterate over image crops, encoding them in batches if requested
+        for (crop_batch,) in batch_iterator(self.encoder_batch_size, crops):
+            crop_features: Sequence[Optional[FeatureSpec]]
+            if self.encoder_batch_size > 1:
+                with stage_timer(stats, "encode"):
+                    crop_features = self._encode_crops(
+                        [images[image_idx] for image_idx, _, _ in crop_batch],
+                        [crop_box for _, crop_box, _ in crop_batch],
+                        feature_cache,
+                        [
+                            self._crop_cache_key(image_keys[image_idx], crop_box)
+                            for image_idx, crop_box, _ in crop_batch
+                        ],
+                        stats,
+                    )
+            else:
+                crop_features = [None] * len(crop_batch)
+            for (image_idx, crop_box, points_for_image), features in zip(
+                crop_batch, crop_features
+            ):
+                yield (
+                    image_idx,
+                    crop_box,
+                    n_crops[image_idx],
+                    points_for_image,
+                    features,
+                    self._crop_cache_key(image_keys[image_idx], crop_box),
+                    score_tables[image_idx],
+                )
+            del crop_features
+
+    @staticmethod
+    def _crop_cache_key(image_key: Optional[str], crop_box: List[int]) -> Optional[str]:
+        if image_key is None:
+            return None
+        return FeatureCache.crop_key(image_key, crop_box)
+
+    def _crop_nms(
+        self,
+        boxes: torch.Tensor,
+        crop_boxes: torch.Tensor,
+        stats: Optional[GenerationStats] = None,
+    ) -> torch.Tensor:
+        """Returns the indices of the masks kept by NMS between different crops."""
+        with stage_timer(stats, "crop_nms"):
+            # Prefer masks from smaller crops
+            scores = 1 / box_area(crop_boxes)
+            scores = scores.to(boxes.device)
+            return batched_nms(
+                boxes.float(),
+                scores,
+                torch.zeros_like(boxes[:, 0]),  # categories
+                iou_threshold=self.crop_nms_thresh,
+            )
+
+    def _get_crop_boxes(
+        self, orig_size: Tuple[int, ...]
+    ) -> Tuple[List[List[int]], List[int]]:
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
         # Filter the crops
-        crop_boxes, layer_idxs = filter_crop_boxes_by_area(
+        return filter_crop_boxes_by_area(
             crop_boxes,
             layer_idxs,
             min_area=self.crop_min_area,
             max_area=self.crop_max_area,
         )
-        # Iterate over image crops
-        data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(
-                image=image,
-                crop_box=crop_box,
-                crop_layer_idx=layer_idx,
-                orig_size=orig_size,
-                local_score_bias=local_score_bias,
-                feature_cache=feature_cache,
-            )
-            data.cat(crop_data)
 
-        # Remove duplicate masks between crops
-        if len(crop_boxes) > 1 and len(data) > 0:
-            # Prefer masks from smaller crops
-            scores = 1 / box_area(data["crop_boxes"])
-            scores = scores.to(data["boxes"].device)
-            keep_by_nms = batched_nms(
-                data["boxes"].float(),
-                scores,
-                torch.zeros_like(data["boxes"][:, 0]),  # categories
-                iou_threshold=self.crop_nms_thresh,
+    def _get_local_score_tables(
+        self, local_score_bias: Optional[np.ndarray]
+    ) -> Dict[str, SummedAreaTable]:
+        """
+        Builds the summed-area tables used to skip crops and masks with low
+        local score bias. Crops are skipped by counting pixels at or over their
+        threshold, which is exact. Masks are skipped on the mean bias over
+        their box. Points read the bias directly, so they need no table.
+        """
+        tables: Dict[str, SummedAreaTable] = {}
+        if local_score_bias is None:
+            return tables
+        if self.min_local_score_thresh_for_crop_skip is not None:
+            tables["crop"] = SummedAreaTable(
+                local_score_bias >= self.min_local_score_thresh_for_crop_skip
             )
-            data.filter(keep_by_nms)
-
-        data.to_numpy()
-        return data
+        if self.min_local_score_thresh_for_mask_skip is not None:
+            tables["mask"] = SummedAreaTable(local_score_bias)
+        return tables
 
-    def _process_crop(
+    def _get_crop_points(
         self,
-        image: np.ndarray,
         crop_box: List[int],
         crop_layer_idx: int,
-        orig_size: Tuple[int, ...],
         local_score_bias: Optional[np.ndarray] = None,
-        feature_cache: Optional[FeatureCache] = None,
-    ) -> MaskData:
-        # Crop the image and calculate embeddings
+        stats: Optional[GenerationStats] = None,
+    ) -> np.ndarray:
+        """
+        Returns the prompt points of a crop in the crop's frame. Points at
+        which the local score bias is not over the threshold for point skip
+        are dropped.
+        """
         x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
-        cropped_im_size = cropped_im.shape[:2]
-
-        # Crop the local score bias
-        if local_score_bias is not None:
-            # Skip crops with low local score bias, if requested
-            cropped_local_score_bias = local_score_bias[y0:y1, x0:x1]
-            if self.min_local_score_thresh_for_crop_skip is not None:
-                if (
-                    cropped_local_score_bias.max()
-                    < self.min_local_score_thresh_for_crop_skip
-                ):
-                    return MaskData()
-        else:
-            cropped_local_score_bias = None
+        cropped_im_size = (y1 - y0, x1 - x0)
 
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
         points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        if stats is not None:
+            stats.add("points", len(points_for_image))
 
         # Filter if required
         if (
-            cropped_local_score_bias is not None
+            local_score_bias is not None
             and self.min_local_score_thresh_for_point_skip is not None
         ):
-            local_scores_at_points = sample_image(
-                cropped_local_score_bias, points_for_image
-            )
-            assert local_scores_at_points.shape[0] == points_for_image.shape[0], (
-                f"Wrong number of points sampled: "
-                f"{local_scores_at_points.shape[0]} != {points_for_image.shape[0]}"
+            # Read the bias at the pixel nearest each point, clipped to the crop
+            pixels = np.round(points_for_image).astype(np.int64)
+            pixels = np.clip(pixels, 0, np.array(cropped_im_size)[::-1] - 1)
+            pixels = pixels + np.array([x0, y0])
+            keep = (
+                local_score_bias[pixels[:, 1], pixels[:, 0]]
+                > self.min_local_score_thresh_for_point_skip
             )
-            points_for_image = points_for_image[
-                local_scores_at_points > self.min_local_score_thresh_for_point_skip
-            ]
+            points_for_image = points_for_image[keep]
+            if stats is not None:
+                stats.add("points_skipped_by_score", int((~keep).sum()))
 
-        # It's possible that we filtered out all points
-        if points_for_image.shape[0] == 0:
-            return MaskData()
+        return points_for_image
 
-        # Functions for caching features
+    def _encode_crops(
+        self,
+        images: List[np.ndarray],
+        crop_boxes: List[List[int]],
+        feature_cache: Optional[FeatureCache] = None,
+        cache_keys: Optional[List[Optional[str]]] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> List[FeatureSpec]:
+        """
+        Computes the features of several image crops, running the crops that
+        are not found in the feature cache through the image encoder as a
+        single batch. The nth crop box is taken from the nth image, and is
+        looked up in the cache under the nth key, if given.
+        """
+        cropped_ims = [
+            image[y0:y1, x0:x1, :]
+            for image, (x0, y0, x1, y1) in zip(images, crop_boxes)
+        ]
+        crop_features: List[Optional[FeatureSpec]] = [None] * len(crop_boxes)
+        keys: List[str] = []
         if feature_cache is not None:
-            feature_retriever = feature_cache.get_retriever_for_image_and_crop_box(
-                cropped_im, crop_box
-            )
-            feature_cacher = feature_cache.get_cacher_for_image_and_crop_box(
-                cropped_im, crop_box
-            )
+            if cache_keys is None:
+                cache_keys = [None] * len(crop_boxes)
+            # Crops without a given key are hashed
+            keys = [
+                key if key is not None else feature_cache.make_key(image, crop_box)
+                for image, crop_box, key in zip(images, crop_boxes, cache_keys)
+            ]
+            crop_features = [feature_cache.get_by_key(key) for key in keys]
+        missing = [i for i, features in enumerate(crop_features) if features is None]
+        if stats is not None and feature_cache is not None:
+            stats.add("feature_cache_hits", len(crop_boxes) - len(missing))
+            stats.add("feature_cache_misses", len(missing))
+        if len(missing) > 0:
+            # This is heavy compute
+            encoded = self.predictor.encode_images([cropped_ims[i] for i in missing])
+            for i, features in zip(missing, encoded):
+                crop_features[i] = features
+                if feature_cache is not None:
+                    # Copy out of the batch so the cache does not keep it alive
+                    feature_cache.get_cacher_for_key(keys[i])(
+                        features=features.features.clone(),
+                        input_size=features.input_size,
+                        original_size=features.original_size,
+                    )
+        encoded_features = [features for features in crop_features if features is not None]
+        assert len(encoded_features) == len(crop_features), "A crop was not encoded."
+        return encoded_features
+
+    def _process_crop(
+        self,
+        image: np.ndarray,
+        crop_box: List[int],
+        points_for_image: np.ndarray,
+        orig_size: Tuple[int, ...],
+        feature_cache: Optional[FeatureCache] = None,
+        crop_features: Optional[FeatureSpec] = None,
+        mask_score_table: Optional[SummedAreaTable] = None,
+        stats: Optional[GenerationStats] = None,
+        cache_key: Optional[str] = None,
+    ) -> MaskData:
+        cropped_im_size = self._set_crop_features(
+            image, crop_box, feature_cache, cache_key, crop_features, stats
+        )
+
+        # Generate masks for this crop in batches, retrying with smaller
+        # batches if they were sized from the memory budget and fail to fit.
+        # Smaller batches are only used for this crop.
+        points_per_batch = self._get_points_per_batch(cropped_im_size, orig_size)
+        data: Optional[MaskData] = None
+        while data is None:
+            # Only the counts of the attempt that succeeds are kept
+            attempt_stats = None if stats is None else GenerationStats()
+            try:
+                data = self._process_points(
+                    points_for_image,
+                    points_per_batch,
+                    cropped_im_size,
+                    crop_box,
+                    orig_size,
+                    mask_score_table=mask_score_table,
+                    stats=attempt_stats,
+                )
+            except (RuntimeError, MemoryError) as e:
+                if (
+                    self.memory_budget_bytes is None
+                    or points_per_batch == 1
+                    or not is_out_of_memory_error(e)
+                ):
+                    raise
+            finally:
+                if stats is not None and attempt_stats is not None:
+                    stats.merge(attempt_stats, counts=data is not None)
+            if data is None:
+                # The failed attempt's tensors are freed with its traceback
+                points_per_batch = max(points_per_batch // 2, 1)
+                if stats is not None:
+                    stats.add("batch_size_fallbacks")
+                if self.predictor.device.type == "cuda":
+                    torch.cuda.empty_cache()
+        self.predictor.reset_image()
+
+        return self._finish_crop(data, crop_box, stats)
+
+    def _set_crop_features(
+        self,
+        image: np.ndarray,
+        crop_box: List[int],
+        feature_cache: Optional[FeatureCache] = None,
+        cache_key: Optional[str] = None,
+        crop_features: Optional[FeatureSpec] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> Tuple[int, ...]:
+        """
+        Sets the features of an image crop in the predictor, from crop_features
+        if given, else from the feature cache or the image encoder. Returns the
+        crop's size.
+        """
+        # Crop the image and calculate embeddings
+        x0, y0, x1, y1 = crop_box
+        cropped_im = image[y0:y1, x0:x1, :]
+        cropped_im_size = cropped_im.shape[:2]
+
+        if crop_features is not None:
+            # The crop has already been encoded as part of a batch
+            with stage_timer(stats, "set_image"):
+                self.predictor.set_torch_features(
+                    features=crop_features.features,
+                    original_size=crop_features.original_size,
+                    input_size=crop_features.input_size,
+                )
         else:
-            feature_retriever = None
-            feature_cacher = None
-        # This is heavy compute
-        self.predictor.set_image(
-            cropped_im,
-            feature_retriever=feature_retriever,
-            feature_cacher=feature_cacher,
+            # Functions for caching features
+            if feature_cache is not None:
+                # The crop's key is derived from the image's key, if given
+                if cache_key is None:
+                    cache_key = feature_cache.make_key(image, crop_box)
+                feature_retriever = feature_cache.get_retriever_for_key(cache_key)
+                feature_cacher = feature_cache.get_cacher_for_key(cache_key)
+                if stats is not None:
+                    feature_retriever = _counting_retriever(feature_retriever, stats)
+            else:
+                feature_retriever = None
+                feature_cacher = None
+            # This is heavy compute
+            with stage_timer(stats, "set_image"):
+                self.predictor.set_image(
+                    cropped_im,
+                    feature_retriever=feature_retriever,
+                    feature_cacher=feature_cacher,
+                )
+        return cropped_im_size
+
+    def _decode_crop(
+        self,
+        image: np.ndarray,
+        crop_box: List[int],
+        points_for_image: np.ndarray,
+        orig_size: Tuple[int, ...],
+        feature_cache: Optional[FeatureCache] = None,
+        cache_key: Optional[str] = None,
+        crop_features: Optional[FeatureSpec] = None,
+        min_pred_iou_thresh: float = 0.0,
+        logits_dtype: torch.dtype = torch.float16,
+        stats: Optional[GenerationStats] = None,
+    ) -> CropDecoderOutputs:
+        """
+        Runs the mask decoder on all points of a crop, keeping its outputs on
+        the CPU with the part of the low res masks that upsampling reads.
+        """
+        cropped_im_size = self._set_crop_features(
+            image, crop_box, feature_cache, cache_key, crop_features, stats
+        )
+        input_h, input_w = self.predictor.input_size
+        # The mask decoder upscales the image embeddings 4x
+        features_h, features_w = self.predictor.features.shape[-2:]
+        low_res_size = (4 * features_h, 4 * features_w)
+        # Bilinear upsampling of the last row and column that cover the crop
+        # also reads the row and column after them
+        valid_h, valid_w = self._valid_low_res_size(low_res_size)
+        valid_h = min(valid_h + 1, low_res_size[0])
+        valid_w = min(valid_w + 1, low_res_size[1])
+        points_per_batch = self._get_points_per_batch(cropped_im_size, orig_size)
+        low_res_masks, iou_preds, points = [], [], []
+        for (batch_points,) in batch_iterator(points_per_batch, points_for_image):
+            data = self._decode_batch(batch_points, cropped_im_size, stats)
+            if min_pred_iou_thresh > 0.0:
+                keep_mask = data["iou_preds"] > min_pred_iou_thresh
+                self._filter_data(data, keep_mask, stats, "masks_dropped_by_iou")
+            assert (
+                tuple(data["low_res_masks"].shape[-2:]) == low_res_size
+            ), "Unexpected low res mask size from the mask decoder."
+            low_res_masks.append(
+                data["low_res_masks"][:, :valid_h, :valid_w].to("cpu", logits_dtype)
+            )
+            iou_preds.append(data["iou_preds"].cpu())
+            points.append(data["points"])
+            del data
+        self.predictor.reset_image()
+
+        return CropDecoderOutputs(
+            crop_box=crop_box,
+            input_size=(input_h, input_w),
+            low_res_size=low_res_size,
+            low_res_masks=torch.cat(low_res_masks),
+            iou_preds=torch.cat(iou_preds),
+            points=torch.cat(points),
         )
 
-        # Generate masks for this crop in batches
+    def _refilter_crop(
+        self,
+        crop_outputs: CropDecoderOutputs,
+        orig_size: Tuple[int, ...],
+        mask_score_table: Optional[SummedAreaTable] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> MaskData:
+        """
+        Post-processes the kept decoder outputs of a crop in batches of
+        points_per_batch points, then removes duplicates within the crop.
+        """
+        crop_box = crop_outputs.crop_box
+        x0, y0, x1, y1 = crop_box
+        cropped_im_size = (y1 - y0, x1 - x0)
+        # Post-processing reads the crop's sizes from the predictor
+        self.predictor.input_size = crop_outputs.input_size
+        self.predictor.original_size = cropped_im_size
+        device = self.predictor.device
+        # Each point has three masks. A crop without masks still gets a batch,
+        # so that its data has every field.
+        batch_size = 3 * self.points_per_batch
         data = MaskData()
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(
-                points, cropped_im_size, crop_box, orig_size
+        for start in range(0, max(len(crop_outputs), 1), batch_size):
+            rows = slice(start, start + batch_size)
+            batch_data = MaskData(
+                low_res_masks=crop_outputs.full_low_res_masks(rows).to(
+                    device, torch.float32
+                ),
+                iou_preds=crop_outputs.iou_preds[rows].to(device),
+                points=crop_outputs.points[rows],
             )
+            with stage_timer(stats, "postprocess"):
+                batch_data = self._postprocess_batch(
+                    batch_data,
+                    cropped_im_size,
+                    crop_box,
+                    orig_size,
+                    mask_score_table,
+                    stats,
+                )
             data.cat(batch_data)
             del batch_data
         self.predictor.reset_image()
 
+        return self._finish_crop(data, crop_box, stats)
+
+    def _finish_crop(
+        self,
+        data: MaskData,
+        crop_box: List[int],
+        stats: Optional[GenerationStats] = None,
+    ) -> MaskData:
+        """
+        Removes duplicate masks within a crop and moves their boxes and points
+        to the original image's frame.
+        """
         # Remove duplicates within this crop.
-        keep_by_nms = batched_nms(
-            data["boxes"].float(),
-            data["iou_preds"],
-            torch.zeros_like(data["boxes"][:, 0]),  # categories
-            iou_threshold=self.box_nms_thresh,
-        )
-        data.filter(keep_by_nms)
+        with stage_timer(stats, "box_nms"):
+            keep_by_nms = batched_nms(
+                data["boxes"].float(),
+                data["iou_preds"],
+                torch.zeros_like(data["boxes"][:, 0]),  # categories
+                iou_threshold=self.box_nms_thresh,
+            )
+        self._filter_data(data, keep_by_nms, stats, "masks_dropped_by_box_nms")
 
         # Return to the original image frame
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
+        # Keep the (N, 4) shape when the crop has no masks left
+        data["crop_boxes"] = torch.tensor(
+            [crop_box for _ in range(len(data["rles"]))]
+        ).reshape(-1, 4)
+
+        return data
+
+    def _get_points_per_batch(
+        self, im_size: Tuple[int, ...], orig_size: Tuple[int, ...]
+    ) -> int:
+        """
+        Returns the number of points to decode at once for a crop of size
+        im_size, whose features must be set in the predictor. With a memory
+        budget, this is the largest batch whose estimated memory fits in it.
+        """
+        if self.memory_budget_bytes is None:
+            return self.points_per_batch
+        features = self.predictor.features
+        itemsize = features.element_size()
+        _, channels, h, w = features.shape
+        n_masks = 3  # Masks kept per point with multimask output
+        # Low res masks are 4x the size of the features, with one more mask
+        # from the decoder than is kept
+        low_res_pixels = 16 * h * w
+        # The decoder repeats the features and their positional encoding for
+        # each point, its transformer keeps about four more copies, and the
+        # upscaling keeps a quarter of the channels at 2x and an eighth at 4x
+        decode_bytes = itemsize * (
+            9 * channels * h * w + (n_masks + 1) * low_res_pixels
+        )
+
+        # Post-processing holds each mask's logits at the crop's size, with
+        # boolean copies for thresholding and RLE encoding
+        crop_pixels = im_size[0] * im_size[1]
+        if self.windowed_upsampling:
+            # Windows are at most the crop's size
+            mask_bytes = (itemsize + 1) * crop_pixels
+        else:
+            # Masks are first upsampled to the padded input size, and are
+            # pasted into the original image before RLE encoding
+            img_size = self.predictor.model.image_encoder.img_size
+            orig_pixels = orig_size[0] * orig_size[1]
+            mask_bytes = (
+                itemsize * (img_size * img_size + crop_pixels)
+                + 2 * crop_pixels
+                + 3 * orig_pixels
+            )
+        postprocess_bytes = n_masks * mask_bytes
+
+        if self.pipelined_postprocessing and not self.adaptive_point_sampling:
+            # A batch is post-processed while later ones are decoded and wait
+            pending_bytes = self._max_pending_batches * n_masks * low_res_pixels
+            point_bytes = decode_bytes + postprocess_bytes + itemsize * pending_bytes
+        else:
+            point_bytes = max(decode_bytes, postprocess_bytes)
+        return max(int(self.memory_budget_bytes // point_bytes), 1)
+
+    def _process_points(
+        self,
+        points_for_image: np.ndarray,
+        points_per_batch: int,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+        mask_score_table: Optional[SummedAreaTable] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> MaskData:
+        """Decodes and post-processes all points of a crop in batches."""
+        if self.adaptive_point_sampling:
+            return self._process_points_adaptively(
+                points_for_image,
+                points_per_batch,
+                im_size,
+                crop_box,
+                orig_size,
+                mask_score_table=mask_score_table,
+                stats=stats,
+            )
+        if self.pipelined_postprocessing:
+            return self._process_points_pipelined(
+                points_for_image,
+                points_per_batch,
+                im_size,
+                crop_box,
+                orig_size,
+                mask_score_table=mask_score_table,
+                stats=stats,
+            )
+        data = MaskData()
+        for (points,) in batch_iterator(points_per_batch, points_for_image):
+            batch_data = self._process_batch(
+                points,
+                im_size,
+                crop_box,
+                orig_size,
+                mask_score_table=mask_score_table,
+                stats=stats,
+            )
+            data.cat(batch_data)
+            del batch_data
+        return data
+
+    def _process_points_pipelined(
+        self,
+        points_for_image: np.ndarray,
+        points_per_batch: int,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+        mask_score_table: Optional[SummedAreaTable] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> MaskData:
+        """
+        Runs the points of a crop in batches, post-processing each decoded batch
+        on a single worker thread while the next batches are decoded. Batches
+        are post-processed and concatenated in order. All batches are finished
+        before returning, since post-processing reads the predictor's sizes.
+        """
+
+        @torch.no_grad()
+        def postprocess(batch_data: MaskData) -> MaskData:
+            with stage_timer(stats, "postprocess"):
+                return self._postprocess_batch(
+                    batch_data, im_size, crop_box, orig_size, mask_score_table, stats
+                )
+
+        data = MaskData()
+        pending: Deque[Future] = deque()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                batches = batch_iterator(points_per_batch, points_for_image)
+                for (points,) in batches:
+                    if len(pending) >= self._max_pending_batches:
+                        data.cat(pending.popleft().result())
+                    batch_data = self._decode_batch(points, im_size, stats)
+                    pending.append(executor.submit(postprocess, batch_data))
+                    del batch_data
+                while pending:
+                    data.cat(pending.popleft().result())
+            finally:
+                for future in pending:
+                    future.cancel()
+        return data
+
+    def _process_points_adaptively(
+        self,
+        points_for_image: np.ndarray,
+        points_per_batch: int,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+        mask_score_table: Optional[SummedAreaTable] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> MaskData:
+        """
+        Runs the points of a crop in batches from coarse to fine, keeping a
+        bitmap of the crop's pixels covered by confident masks. Queued points
+        on covered pixels are dropped before each batch.
+        """
+        x0, y0, _, _ = crop_box
+        orig_h, orig_w = orig_size
+        points = points_for_image[coarse_to_fine_order(points_for_image)]
+        coverage = np.zeros(im_size, dtype=bool)
+        data = MaskData()
+        while len(points) > 0:
+            batch_data = self._process_batch(
+                points[:points_per_batch],
+                im_size,
+                crop_box,
+                orig_size,
+                mask_score_table=mask_score_table,
+                stats=stats,
+            )
+            points = points[points_per_batch:]
+
+            # Mark the pixels of confident masks, whose boxes are in the crop's
+            # frame while their RLEs are in the original image's frame
+            confident = batch_data["iou_preds"] >= self.adaptive_sampling_iou_thresh
+            rles = batch_data["rles"][confident]
+            boxes = batch_data["boxes"][confident].tolist()
+            for i, (bx0, by0, bx1, by1) in enumerate(boxes):
+                window = rle_counts_to_window(
+                    rles.counts[rles.offsets[i] : rles.offsets[i + 1]],
+                    (orig_h, orig_w),
+                    [bx0 + x0, by0 + y0, bx1 + x0, by1 + y0],
+                )
+                coverage[by0 : by1 + 1, bx0 : bx1 + 1] |= window
+            data.cat(batch_data)
+            del batch_data
+
+            # Drop the queued points that are already covered
+            cols = np.clip(points[:, 0].astype(np.int64), 0, im_size[1] - 1)
+            rows = np.clip(points[:, 1].astype(np.int64), 0, im_size[0] - 1)
+            covered = coverage[rows, cols]
+            points = points[~covered]
+            if stats is not None:
+                stats.add("points_skipped_by_coverage", int(covered.sum()))
 
         return data
 
@@ -391,46 +1412,92 @@ class SamAutomaticMaskGenerator:
         im_size: Tuple[int, ...],
         crop_box: List[int],
         orig_size: Tuple[int, ...],
+        mask_score_table: Optional[SummedAreaTable] = None,
+        stats: Optional[GenerationStats] = None,
     ) -> MaskData:
-        orig_h, orig_w = orig_size
+        data = self._decode_batch(points, im_size, stats)
+        with stage_timer(stats, "postprocess"):
+            return self._postprocess_batch(
+                data, im_size, crop_box, orig_size, mask_score_table, stats
+            )
 
+    def _decode_batch(
+        self,
+        points: np.ndarray,
+        im_size: Tuple[int, ...],
+        stats: Optional[GenerationStats] = None,
+    ) -> MaskData:
+        """Runs the mask decoder on a batch of points in the crop's frame."""
         # Run model on this batch
         transformed_points = self.predictor.transform.apply_coords(points, im_size)
         in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
         in_labels = torch.ones(
             in_points.shape[0], dtype=torch.int, device=in_points.device
         )
-        masks, iou_preds, _ = self.predictor.predict_torch(
-            in_points[:, None, :],
-            in_labels[:, None],
-            multimask_output=True,
-            return_logits=True,
-        )
+        with stage_timer(stats, "decode"):
+            low_res_masks, iou_preds = self.predictor.predict_low_res_torch(
+                in_points[:, None, :],
+                in_labels[:, None],
+                multimask_output=True,
+            )
+        if stats is not None:
+            stats.add("points_decoded", len(points))
+            stats.add("masks_decoded", low_res_masks.shape[0] * low_res_masks.shape[1])
 
         # Serialize predictions and store in MaskData
-        data = MaskData(
-            masks=masks.flatten(0, 1),
+        return MaskData(
+            low_res_masks=low_res_masks.flatten(0, 1),
             iou_preds=iou_preds.flatten(0, 1),
-            points=torch.as_tensor(points.repeat(masks.shape[1], axis=0)),
+            points=torch.as_tensor(points.repeat(low_res_masks.shape[1], axis=0)),
         )
-        del masks
 
-        # TODO: Add an additional filter that looks at the integral of the score bias.
+    def _postprocess_batch(
+        self,
+        data: MaskData,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+        mask_score_table: Optional[SummedAreaTable] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> MaskData:
+        """
+        Filters the decoder's masks for a batch of points, then upsamples the
+        masks left and compresses them to RLEs in the original image's frame.
+        """
+        orig_h, orig_w = orig_size
 
-        # Filter by predicted IoU
+        # Filter by predicted IoU, before any mask is upsampled
         if self.pred_iou_thresh > 0.0:
             keep_mask = data["iou_preds"] > self.pred_iou_thresh
-            data.filter(keep_mask)
+            self._filter_data(data, keep_mask, stats, "masks_dropped_by_iou")
+
+        if self.low_res_filtering:
+            self._filter_low_res_masks(data, im_size, crop_box, orig_size, stats)
+
+        if self.windowed_upsampling:
+            self._process_mask_windows(
+                data, crop_box, orig_size, mask_score_table, stats
+            )
+            return data
+
+        # Upsample the remaining masks to the crop's resolution
+        data["masks"] = self.predictor.model.postprocess_masks(
+            data["low_res_masks"][:, None, :, :],
+            self.predictor.input_size,
+            self.predictor.original_size,
+        )[:, 0]
+        del data["low_res_masks"]
 
         # Calculate stability score
-        data["stability_score"] = calculate_stability_score(
-            data["masks"],
-            self.predictor.model.mask_threshold,
-            self.stability_score_offset,
-        )
-        if self.stability_score_thresh > 0.0:
-            keep_mask = data["stability_score"] >= self.stability_score_thresh
-            data.filter(keep_mask)
+        if not self.low_res_filtering:
+            data["stability_score"] = calculate_stability_score(
+                data["masks"],
+                self.predictor.model.mask_threshold,
+                self.stability_score_offset,
+            )
+            if self.stability_score_thresh > 0.0:
+                keep_mask = data["stability_score"] >= self.stability_score_thresh
+                self._filter_data(data, keep_mask, stats, "masks_dropped_by_stability")
 
         # Threshold masks and calculate boxes
         data["masks"] = data["masks"] > self.predictor.model.mask_threshold
@@ -441,22 +1508,235 @@ class SamAutomaticMaskGenerator:
             data["boxes"], crop_box, [0, 0, orig_w, orig_h]
         )
         if not torch.all(keep_mask):
-            data.filter(keep_mask)
+            self._filter_data(data, keep_mask, stats, "masks_dropped_by_edge")
+
+        # Filter by the local score bias over each box
+        self._filter_by_local_score(data, crop_box, mask_score_table, stats)
 
         # Compress to RLE
         data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
+        data["rles"] = PackedRLEs.from_counts(
+            *mask_to_rle_counts_pytorch(data["masks"]), (orig_h, orig_w)
+        )
         del data["masks"]
 
         return data
 
+    def _filter_low_res_masks(
+        self,
+        data: MaskData,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+        stats: Optional[GenerationStats] = None,
+    ) -> None:
+        """
+        Computes approximate stability scores and boxes from the low resolution
+        mask logits in data, and filters on them. Edits data in place. Upsampling
+        can move a box edge by about one low res pixel, so the crop edge filter
+        only drops masks that are near a crop edge with that margin. Borderline
+        and empty masks are left to the full resolution check.
+        """
+        orig_h, orig_w = orig_size
+        low_res_h, low_res_w = data["low_res_masks"].shape[-2:]
+        img_size = self.predictor.model.image_encoder.img_size
+        input_h, input_w = self.predictor.input_size
+        valid_h, valid_w = self._valid_low_res_size((low_res_h, low_res_w))
+        low_res_masks = data["low_res_masks"][..., :valid_h, :valid_w]
+
+        # Calculate stability score
+        data["stability_score"] = calculate_stability_score(
+            low_res_masks,
+            self.predictor.model.mask_threshold,
+            self.stability_score_offset,
+        )
+        if self.stability_score_thresh > 0.0:
+            keep_mask = data["stability_score"] >= self.stability_score_thresh
+            self._filter_data(data, keep_mask, stats, "masks_dropped_by_stability")
+            low_res_masks = data["low_res_masks"][..., :valid_h, :valid_w]
+
+        # Filter boxes that touch crop boundaries, with the boxes scaled from the
+        # low res pixel grid to the crop's pixel grid
+        low_res_binary = low_res_masks > self.predictor.model.mask_threshold
+        boxes = batched_mask_to_box(low_res_binary)
+        scale_x = (img_size / low_res_w) * (im_size[1] / input_w)
+        scale_y = (img_size / low_res_h) * (im_size[0] / input_h)
+        scale = torch.tensor([scale_x, scale_y, scale_x, scale_y], device=boxes.device)
+        # Low res pixel i covers crop pixels [i * scale, (i + 1) * scale)
+        boxes = (boxes + torch.tensor([0, 0, 1, 1], device=boxes.device)) * scale
+        boxes = boxes - torch.tensor([0, 0, 1, 1], device=boxes.device)
+        near_edge = is_box_near_crop_edge(
+            boxes, crop_box, [0, 0, orig_w, orig_h], margin=scale
+        )
+        keep_mask = ~(near_edge & low_res_binary.flatten(1).any(1))
+        if not torch.all(keep_mask):
+            self._filter_data(data, keep_mask, stats, "masks_dropped_by_edge")
+
+    def _valid_low_res_size(self, low_res_size: Tuple[int, int]) -> Tuple[int, int]:
+        """
+        Returns the size of the top-left part of the low res masks that covers
+        the crop set in the predictor. The rest corresponds to the padding
+        added before the image encoder.
+        """
+        img_size = self.predictor.model.image_encoder.img_size
+        input_h, input_w = self.predictor.input_size
+        return (
+            int(np.ceil(input_h * low_res_size[0] / img_size)),
+            int(np.ceil(input_w * low_res_size[1] / img_size)),
+        )
+
+    def _process_mask_windows(
+        self,
+        data: MaskData,
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+        mask_score_table: Optional[SummedAreaTable] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> None:
+        """
+        Does the work of '_process_batch' after the low resolution filters, but
+        upsamples each mask only within the window around it and encodes the
+        RLEs directly from the windows. Edits data in place.
+        """
+        orig_h, orig_w = orig_size
+        mask_threshold = self.predictor.model.mask_threshold
+        low_res_h, low_res_w = data["low_res_masks"].shape[-2:]
+        img_size = self.predictor.model.image_encoder.img_size
+        device = data["low_res_masks"].device
+        matrix_y = mask_upsampling_matrix(
+            low_res_h,
+            img_size,
+            self.predictor.input_size[0],
+            self.predictor.original_size[0],
+            str(device),
+        )
+        matrix_x = mask_upsampling_matrix(
+            low_res_w,
+            img_size,
+            self.predictor.input_size[1],
+            self.predictor.original_size[1],
+            str(device),
+        )
+
+        # Upsample each mask within its window. If the stability score is still
+        # to be computed, the window must hold every pixel above the low cutoff.
+        window_threshold = mask_threshold
+        if not self.low_res_filtering:
+            window_threshold -= abs(self.stability_score_offset)
+        data["mask_windows"] = []
+        data["window_offsets"] = []
+        for low_res_mask in data["low_res_masks"]:
+            window, offset = upsample_mask_window(
+                low_res_mask, matrix_y, matrix_x, window_threshold
+            )
+            data["mask_windows"].append(window)
+            data["window_offsets"].append(offset)
+        del data["low_res_masks"]
+
+        # Calculate stability score
+        if not self.low_res_filtering:
+            stability_scores = [
+                calculate_stability_score(
+                    window, mask_threshold, self.stability_score_offset
+                )
+                for window in data["mask_windows"]
+            ]
+            data["stability_score"] = (
+                torch.stack(stability_scores)
+                if len(stability_scores) > 0
+                else torch.zeros(0, device=device)
+            )
+            if self.stability_score_thresh > 0.0:
+                keep_mask = data["stability_score"] >= self.stability_score_thresh
+                self._filter_data(data, keep_mask, stats, "masks_dropped_by_stability")
+
+        # Threshold masks and calculate boxes, in the crop's frame
+        data["mask_windows"] = [
+            window > mask_threshold for window in data["mask_windows"]
+        ]
+        boxes = [torch.zeros(0, 4, dtype=torch.long, device=device)]
+        for window, (x, y) in zip(data["mask_windows"], data["window_offsets"]):
+            # Empty masks keep the box [0, 0, 0, 0]
+            offset = torch.tensor([x, y, x, y], device=device) * window.any()
+            boxes.append((batched_mask_to_box(window) + offset)[None])
+        data["boxes"] = torch.cat(boxes, dim=0)
+
+        # Filter boxes that touch crop boundaries
+        keep_mask = ~is_box_near_crop_edge(
+            data["boxes"], crop_box, [0, 0, orig_w, orig_h]
+        )
+        if not torch.all(keep_mask):
+            self._filter_data(data, keep_mask, stats, "masks_dropped_by_edge")
+
+        # Filter by the local score bias over each box
+        self._filter_by_local_score(data, crop_box, mask_score_table, stats)
+
+        # Compress to RLE in the original image's frame
+        crop_x0, crop_y0, _, _ = crop_box
+        counts = [
+            window_mask_to_rle_counts_pytorch(
+                window, (x + crop_x0, y + crop_y0), (orig_h, orig_w)
+            )
+            for window, (x, y) in zip(data["mask_windows"], data["window_offsets"])
+        ]
+        offsets = np.cumsum([0] + [len(c) for c in counts])
+        data["rles"] = PackedRLEs.from_counts(
+            torch.cat(counts) if len(counts) > 0 else np.zeros(0),
+            offsets,
+            (orig_h, orig_w),
+        )
+        del data["mask_windows"]
+        del data["window_offsets"]
+
+    def _filter_by_local_score(
+        self,
+        data: MaskData,
+        crop_box: List[int],
+        mask_score_table: Optional[SummedAreaTable] = None,
+        stats: Optional[GenerationStats] = None,
+    ) -> None:
+        """
+        Drops masks whose mean local score bias over their box, given in the
+        crop's frame, is below the threshold for mask skip. Edits data in place.
+        """
+        if mask_score_table is None or len(data["boxes"]) == 0:
+            return
+        boxes = uncrop_boxes_xyxy(data["boxes"], crop_box).cpu().numpy()
+        # Boxes include their right and bottom edges
+        means = mask_score_table.box_means(boxes + np.array([0, 0, 1, 1]))
+        keep_mask_np = means >= self.min_local_score_thresh_for_mask_skip
+        if not keep_mask_np.all():
+            keep_mask = torch.as_tensor(keep_mask_np, device=data["boxes"].device)
+            self._filter_data(data, keep_mask, stats, "masks_dropped_by_score")
+
+    @staticmethod
+    def _filter_data(
+        data: MaskData,
+        keep: torch.Tensor,
+        stats: Optional[GenerationStats],
+        counter: str,
+    ) -> None:
+        """
+        Filters data by a boolean mask or by indices, adding the number of
+        rows dropped to the given counter of stats.
+        """
+        if stats is not None:
+            n_kept = int(keep.sum()) if keep.dtype == torch.bool else len(keep)
+            stats.add(counter, len(data) - n_kept)
+        data.filter(keep)
+
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData,
+        min_area: int,
+        nms_thresh: float,
+        num_workers: Optional[int] = None,
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
-        box NMS to remove any new duplicates.
+        box NMS to remove any new duplicates. Each mask is only decoded and
+        cleaned in the window around its box, and masks are processed by a
+        pool of num_workers threads, which defaults to the pool's default.
 
         Edits mask_data in place.
 
@@ -465,42 +1745,77 @@ class SamAutomaticMaskGenerator:
         if len(mask_data["rles"]) == 0:
             return mask_data
 
+        rles = mask_data["rles"]
+        if not isinstance(rles, PackedRLEs):
+            rles = PackedRLEs.from_dicts(rles)
+        h, w = rles.sizes[0]
+        size = (int(h), int(w))
+
+        def clean_mask(
+            idx: int, box: List[int]
+        ) -> Tuple[np.ndarray, Tuple[int, int], bool, List[int]]:
+            counts = rles.counts[rles.offsets[idx] : rles.offsets[idx + 1]]
+            window, offset, changed = remove_small_regions_in_box(
+                counts, size, box, min_area
+            )
+            return window, offset, changed, window_to_box(window, offset)
+
         # Filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
-
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
-            # Give score=0 to changed masks and score=1 to unchanged masks
-            # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
-
-        # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            results = list(
+                executor.map(clean_mask, range(len(rles)), rles.boxes().tolist())
+            )
+        windows, offsets, changes, boxes = zip(*results)
+        boxes = torch.as_tensor(boxes)
+        # Give score=0 to changed masks and score=1 to unchanged masks
+        # so NMS will prefer ones that didn't need postprocessing
+        scores = torch.as_tensor([float(not changed) for changed in changes])
+
+        # Remove any new duplicates
         keep_by_nms = batched_nms(
             boxes.float(),
-            torch.as_tensor(scores),
+            scores,
             torch.zeros_like(boxes[:, 0]),  # categories
             iou_threshold=nms_thresh,
         )
 
         # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
-                mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
+        changed = [int(i_mask) for i_mask in keep_by_nms if changes[i_mask]]
+        if len(changed) > 0:
+            counts = [
+                window_mask_to_rle_counts_pytorch(
+                    torch.as_tensor(windows[i_mask]), offsets[i_mask], size
+                )
+                for i_mask in changed
+            ]
+            new_rles = PackedRLEs.from_counts(
+                torch.cat(counts), np.cumsum([0] + [len(c) for c in counts]), size
+            )
+            mask_data["rles"] = rles.replace(np.array(changed), new_rles)
+            mask_data["boxes"][changed] = boxes[changed]  # update res directly
         mask_data.filter(keep_by_nms)
 
         return mask_data
 
     def clear_feature_cache(self) -> None:
         if self.feature_cache is not None:
-            self.feature_cache.clear()
\ No newline at end of file
+            self.feature_cache.clear()
+
+
+def _crop_box_xywh(crop_box: List[int]) -> List[int]:
+    x0, y0, x1, y1 = crop_box
+    return [x0, y0, x1 - x0, y1 - y0]
+
+
+def _counting_retriever(retriever: Callable, stats: GenerationStats) -> Callable:
+    """Wraps a feature retriever to count feature cache hits and misses."""
+
+    def counting_retriever() -> Optional[FeatureSpec]:
+        features = retriever()
+        if features is not None:
+            stats.add("feature_cache_hits")
+        else:
+            stats.add("feature_cache_misses")
+        return features
+
+    return counting_retriever
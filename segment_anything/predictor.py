@@ -9,8 +9,9 @@ import torch
 
 from segment_anything.modeling import Sam
 
-from typing import Optional, Tuple, Callable
+from typing import Optional, Tuple, Callable, List
 
+from .utils.amg import FeatureSpec
 from .utils.transforms import ResizeLongestSide
 
 
@@ -120,6 +121,54 @@ class SamPredictor:
                 input_size=self.input_size,
             )
 
+    @torch.no_grad()
+    def encode_images(
+        self,
+        images: List[np.ndarray],
+        image_format: str = "RGB",
+    ) -> List[FeatureSpec]:
+        """
+        Calculates the image embeddings for a list of images with a single
+        batched pass through the image encoder, without setting any of them
+        as the current image. The images may have different sizes, since
+        each one is resized and padded to the input size of the encoder.
+        The returned features can be set with 'set_torch_features'.
+
+        Arguments:
+          images (list(np.ndarray)): The images to encode. Expects images
+            in HWC uint8 format, with pixel values in [0, 255].
+          image_format (str): The color format of the images, in ['RGB', 'BGR'].
+
+        Returns:
+          (list(FeatureSpec)): The features of each image, with shape
+            1xCxHxW, together with its original and input sizes.
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        input_images, original_sizes, input_sizes = [], [], []
+        for image in images:
+            if image_format != self.model.image_format:
+                image = image[..., ::-1]
+            input_image = self.transform.apply_image(image)
+            input_image_torch = torch.as_tensor(input_image, device=self.device)
+            input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()
+            original_sizes.append((image.shape[0], image.shape[1]))
+            input_sizes.append((input_image_torch.shape[-2], input_image_torch.shape[-1]))
+            input_images.append(self.model.preprocess(input_image_torch))
+        features = self.model.image_encoder(torch.stack(input_images, dim=0))
+        return [
+            FeatureSpec(
+                features=features[i : i + 1],
+                original_size=original_size,
+                input_size=input_size,
+            )
+            for i, (original_size, input_size) in enumerate(
+                zip(original_sizes, input_sizes)
+            )
+        ]
+
     def set_torch_features(
         self,
         features: torch.Tensor,
@@ -130,7 +179,8 @@ class SamPredictor:
         # This spoofs set_torch_image, but without the image processing.
         self.original_size = original_size
         self.input_size = input_size
-        self.features = features
+        # Features may come from a cache on another device
+        self.features = features.to(self.device)
         self.is_image_set = True
 
     def predict(
@@ -262,6 +312,45 @@ class SamPredictor:
             of masks and H=W=256. These low res logits can be passed to
             a subsequent iteration as mask input.
         """
+        low_res_masks, iou_predictions = self.predict_low_res_torch(
+            point_coords,
+            point_labels,
+            boxes,
+            mask_input,
+            multimask_output,
+        )
+
+        # Upscale the masks to the original image resolution
+        masks = self.model.postprocess_masks(
+            low_res_masks, self.input_size, self.original_size
+        )
+
+        if not return_logits:
+            masks = masks > self.model.mask_threshold
+
+        return masks, iou_predictions, low_res_masks
+
+    @torch.no_grad()
+    def predict_low_res_torch(
+        self,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor] = None,
+        mask_input: Optional[torch.Tensor] = None,
+        multimask_output: bool = True,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Predict masks for the given input prompts, using the currently set image,
+        without upscaling them to the original image resolution. Takes the same
+        inputs as 'predict_torch'. The masks can be brought to the original
+        image resolution with the model's 'postprocess_masks'.
+
+        Returns:
+          (torch.Tensor): An array of shape BxCxHxW, where C is the number
+            of masks and H=W=256, containing the low resolution mask logits.
+          (torch.Tensor): An array of shape BxC containing the model's
+            predictions for the quality of each mask.
+        """
         if not self.is_image_set:
             raise RuntimeError(
                 "An image must be set with .set_image(...) before mask prediction."
@@ -287,16 +376,7 @@ class SamPredictor:
             dense_prompt_embeddings=dense_embeddings,
             multimask_output=multimask_output,
         )
-
-        # Upscale the masks to the original image resolution
-        masks = self.model.postprocess_masks(
-            low_res_masks, self.input_size, self.original_size
-        )
-
-        if not return_logits:
-            masks = masks > self.model.mask_threshold
-
-        return masks, iou_predictions, low_res_masks
+        return low_res_masks, iou_predictions
 
     def get_image_embedding(self) -> torch.Tensor:
         """
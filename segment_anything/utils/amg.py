@@ -4,8 +4,12 @@
 # LICENSE file in the root directory of this source tree.
 
 import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from functools import partial
+from functools import lru_cache, partial
 
 import numpy as np
 import torch
@@ -13,72 +17,151 @@ import torch
 import math
 from copy import deepcopy
 from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple, Union, Callable, Optional
+from typing import (
+    Any,
+    Dict,
+    Generator,
+    ItemsView,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+    Callable,
+    Optional,
+    Sequence,
+    overload,
+)
+
+from .feature_store import DiskFeatureStore
 
 
 class MaskData:
     """
     A structure for storing masks and their related data in batched format.
     Implements basic filtering and concatenation.
+
+    Tensor and numpy fields are stored column by column in buffers that
+    grow geometrically, so that repeated concatenation copies each row a
+    constant number of times on average. Reading a field returns a view of
+    the valid part of its buffer, without copying.
     """
 
     def __init__(self, **kwargs) -> None:
         for v in kwargs.values():
             assert isinstance(
-                v, (list, np.ndarray, torch.Tensor)
-            ), "MaskData only supports list, numpy arrays, and torch tensors."
+                v, (list, np.ndarray, torch.Tensor, PackedRLEs)
+            ), "MaskData only supports list, numpy arrays, torch tensors and PackedRLEs."
         self._stats = dict(**kwargs)
+        # Number of valid rows of each tensor or numpy buffer in _stats
+        self._lengths = {k: len(v) for k, v in self._stats.items() if _is_array(v)}
 
     def __setitem__(self, key: str, item: Any) -> None:
         assert isinstance(
-            item, (list, np.ndarray, torch.Tensor)
-        ), "MaskData only supports list, numpy arrays, and torch tensors."
+            item, (list, np.ndarray, torch.Tensor, PackedRLEs)
+        ), "MaskData only supports list, numpy arrays, torch tensors and PackedRLEs."
         self._stats[key] = item
+        self._lengths.pop(key, None)
+        if _is_array(item):
+            self._lengths[key] = len(item)
 
     def __delitem__(self, key: str) -> None:
         del self._stats[key]
+        self._lengths.pop(key, None)
 
     def __getitem__(self, key: str) -> Any:
-        return self._stats[key]
+        v = self._stats[key]
+        if key in self._lengths and self._lengths[key] < len(v):
+            return v[: self._lengths[key]]
+        return v
 
     def items(self) -> ItemsView[str, Any]:
-        return self._stats.items()
+        return {k: self[k] for k in self._stats}.items()
 
     def filter(self, keep: torch.Tensor) -> None:
-        for k, v in self._stats.items():
+        keep_list = None
+        for k in list(self._stats.keys()):
+            v = self[k]
             if v is None:
                 self._stats[k] = None
             elif isinstance(v, torch.Tensor):
-                self._stats[k] = v[torch.as_tensor(keep, device=v.device)]
+                self[k] = v[torch.as_tensor(keep, device=v.device)]
             elif isinstance(v, np.ndarray):
-                self._stats[k] = v[keep.detach().cpu().numpy()]
-            elif isinstance(v, list) and keep.dtype == torch.bool:
-                self._stats[k] = [a for i, a in enumerate(v) if keep[i]]
+                self[k] = v[keep.detach().cpu().numpy()]
+            elif isinstance(v, PackedRLEs):
+                self[k] = v[keep]
             elif isinstance(v, list):
-                self._stats[k] = [v[i] for i in keep]
+                if keep_list is None:
+                    # Convert the selection once instead of once per element
+                    keep_tensor = torch.as_tensor(keep)
+                    if keep_tensor.dtype == torch.bool:
+                        keep_tensor = keep_tensor.nonzero().flatten()
+                    keep_list = keep_tensor.tolist()
+                self[k] = [v[i] for i in keep_list]
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
 
     def cat(self, new_stats: "MaskData") -> None:
         for k, v in new_stats.items():
             if k not in self._stats or self._stats[k] is None:
-                self._stats[k] = deepcopy(v)
-            elif isinstance(v, torch.Tensor):
-                self._stats[k] = torch.cat([self._stats[k], v], dim=0)
-            elif isinstance(v, np.ndarray):
-                self._stats[k] = np.concatenate([self._stats[k], v], axis=0)
-            elif isinstance(v, list):
-                self._stats[k] = self._stats[k] + deepcopy(v)
+                # Copy, so that in-place edits of either MaskData do not
+                # change the other
+                self[k] = _copy_field(v)
+            elif isinstance(v, (torch.Tensor, np.ndarray)):
+                # Like torch.cat, skip empty values, whose shape may not match
+                if len(v) == 0:
+                    continue
+                if self._lengths[k] == 0:
+                    self[k] = _copy_field(v)
+                elif isinstance(v, torch.Tensor):
+                    self._append_tensor(k, v)
+                else:
+                    self._append_numpy(k, v)
+            elif isinstance(v, (list, PackedRLEs)):
+                self._stats[k].extend(v)
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
 
+    def _append_tensor(self, key: str, v: torch.Tensor) -> None:
+        """Appends rows to a tensor field, growing its buffer if needed."""
+        buffer: torch.Tensor = self._stats[key]
+        length = self._lengths[key]
+        new_length = length + len(v)
+        dtype = torch.promote_types(buffer.dtype, v.dtype)
+        if new_length > len(buffer) or dtype != buffer.dtype:
+            _check_row_shape(key, buffer.shape, v.shape)
+            capacity = max(new_length, 2 * len(buffer))
+            new_buffer = torch.empty(
+                (capacity, *buffer.shape[1:]), dtype=dtype, device=buffer.device
+            )
+            new_buffer[:length] = buffer[:length]
+            buffer = new_buffer
+        buffer[length:new_length] = v
+        self._stats[key] = buffer
+        self._lengths[key] = new_length
+
+    def _append_numpy(self, key: str, v: np.ndarray) -> None:
+        """Appends rows to a numpy field, growing its buffer if needed."""
+        buffer: np.ndarray = self._stats[key]
+        length = self._lengths[key]
+        new_length = length + len(v)
+        dtype = np.result_type(buffer.dtype, v.dtype)
+        if new_length > len(buffer) or dtype != buffer.dtype:
+            _check_row_shape(key, buffer.shape, v.shape)
+            capacity = max(new_length, 2 * len(buffer))
+            new_buffer = np.empty((capacity, *buffer.shape[1:]), dtype=dtype)
+            new_buffer[:length] = buffer[:length]
+            buffer = new_buffer
+        buffer[length:new_length] = v
+        self._stats[key] = buffer
+        self._lengths[key] = new_length
+
     def to_numpy(self) -> None:
-        for k, v in self._stats.items():
+        for k, v in self.items():
             if isinstance(v, torch.Tensor):
-                self._stats[k] = v.detach().cpu().numpy()
+                self[k] = v.detach().cpu().numpy()
 
     def __len__(self):
-        lens = [len(v) for v in self._stats.values()]
+        lens = [len(self[k]) for k in self._stats]
         if len(lens) == 0:
             return 0
         assert all(
@@ -87,15 +170,247 @@ class MaskData:
         return lens[0]
 
 
+def _is_array(v: Any) -> bool:
+    return isinstance(v, (torch.Tensor, np.ndarray))
+
+
+def _copy_field(v: Any) -> Any:
+    return v.clone() if isinstance(v, torch.Tensor) else v.copy()
+
+
+def _check_row_shape(key: str, buffer_shape: Sequence[int], v_shape: Sequence[int]) -> None:
+    assert tuple(buffer_shape[1:]) == tuple(
+        v_shape[1:]
+    ), f"MaskData key {key} has inconsistent shapes."
+
+
+class PackedRLEs:
+    """
+    A compact container for uncompressed RLEs. The counts of all masks are
+    held in one int32 buffer, along with each mask's offset into it and its
+    size. Indexing with an int gives the RLE as a dict in the format expected
+    by pycoco tools, while indexing with a slice, index array or boolean mask
+    gives a new PackedRLEs. Appending grows the buffers geometrically.
+    """
+
+    def __init__(
+        self,
+        counts: Optional[np.ndarray] = None,
+        offsets: Optional[np.ndarray] = None,
+        sizes: Optional[np.ndarray] = None,
+    ) -> None:
+        self._counts = np.zeros(0, dtype=np.int32)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._sizes = np.zeros((0, 2), dtype=np.int32)
+        if counts is not None:
+            assert (
+                offsets is not None and sizes is not None
+            ), "PackedRLEs needs offsets and sizes along with counts."
+            self._counts = np.asarray(counts, dtype=np.int32)
+            self._offsets = np.asarray(offsets, dtype=np.int64)
+            self._sizes = np.asarray(sizes, dtype=np.int32).reshape(-1, 2)
+        self._len = len(self._sizes)
+        self._num_counts = int(self._offsets[self._len])
+
+    @classmethod
+    def from_counts(
+        cls,
+        counts: Union[torch.Tensor, np.ndarray],
+        offsets: Union[torch.Tensor, np.ndarray],
+        size: Tuple[int, int],
+    ) -> "PackedRLEs":
+        """
+        Builds PackedRLEs for masks of the same size from flat counts and
+        offsets, as returned by mask_to_rle_counts_pytorch.
+        """
+        if torch.is_tensor(counts):
+            counts = counts.detach().cpu().numpy()
+        if torch.is_tensor(offsets):
+            offsets = offsets.detach().cpu().numpy()
+        sizes = np.tile(np.asarray(size, dtype=np.int32), (len(offsets) - 1, 1))
+        return cls(counts, offsets - offsets[0], sizes)
+
+    @classmethod
+    def from_dicts(cls, rles: List[Dict[str, Any]]) -> "PackedRLEs":
+        """Builds PackedRLEs from a list of uncompressed RLEs."""
+        if len(rles) == 0:
+            return cls()
+        lengths = np.array([len(rle["counts"]) for rle in rles], dtype=np.int64)
+        offsets = np.zeros(len(rles) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        counts = np.concatenate(
+            [np.asarray(rle["counts"], dtype=np.int32) for rle in rles]
+        )
+        sizes = np.array([rle["size"] for rle in rles], dtype=np.int32)
+        return cls(counts, offsets, sizes)
+
+    @classmethod
+    def cat(cls, rles_list: List["PackedRLEs"]) -> "PackedRLEs":
+        out = cls()
+        for rles in rles_list:
+            out.extend(rles)
+        return out
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self._counts[: self._num_counts]
+
+    @property
+    def offsets(self) -> np.ndarray:
+        return self._offsets[: self._len + 1]
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return self._sizes[: self._len]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Generator[Dict[str, Any], None, None]:
+        counts = self.counts.tolist()
+        offsets = self.offsets.tolist()
+        sizes = self.sizes.tolist()
+        for i in range(self._len):
+            yield {"size": sizes[i], "counts": counts[offsets[i] : offsets[i + 1]]}
+
+    @overload
+    def __getitem__(self, idx: Union[int, np.integer]) -> Dict[str, Any]:
+        ...
+
+    @overload
+    def __getitem__(
+        self, idx: Union[slice, Sequence[int], np.ndarray, torch.Tensor]
+    ) -> "PackedRLEs":
+        ...
+
+    def __getitem__(self, idx: Any) -> Union[Dict[str, Any], "PackedRLEs"]:
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += self._len
+            start, end = self._offsets[idx], self._offsets[idx + 1]
+            return {
+                "size": self._sizes[idx].tolist(),
+                "counts": self._counts[start:end].tolist(),
+            }
+        if isinstance(idx, slice):
+            idx = np.arange(self._len)[idx]
+        if torch.is_tensor(idx):
+            idx = idx.detach().cpu().numpy()
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.nonzero(idx)[0]
+        idx = idx.astype(np.int64).reshape(-1)
+        # Gather the counts of the selected masks in one indexing operation
+        starts = self._offsets[idx]
+        lengths = self._offsets[idx + 1] - starts
+        offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        positions = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+        return PackedRLEs(self._counts[positions], offsets, self._sizes[idx])
+
+    def copy(self) -> "PackedRLEs":
+        return PackedRLEs(self.counts.copy(), self.offsets.copy(), self.sizes.copy())
+
+    def extend(self, other: Union["PackedRLEs", List[Dict[str, Any]]]) -> None:
+        """Appends RLEs in place, growing the buffers if needed."""
+        if not isinstance(other, PackedRLEs):
+            other = PackedRLEs.from_dicts(list(other))
+        new_len = self._len + len(other)
+        new_num_counts = self._num_counts + len(other.counts)
+        if new_len + 1 > len(self._offsets):
+            capacity = max(new_len + 1, 2 * len(self._offsets))
+            self._offsets = _grow(self._offsets, capacity, self._len + 1)
+            self._sizes = _grow(self._sizes, capacity, self._len)
+        if new_num_counts > len(self._counts):
+            capacity = max(new_num_counts, 2 * len(self._counts))
+            self._counts = _grow(self._counts, capacity, self._num_counts)
+        self._counts[self._num_counts : new_num_counts] = other.counts
+        self._offsets[self._len + 1 : new_len + 1] = (
+            other.offsets[1:] + self._num_counts
+        )
+        self._sizes[self._len : new_len] = other.sizes
+        self._len, self._num_counts = new_len, new_num_counts
+
+    def replace(self, idx: np.ndarray, other: "PackedRLEs") -> "PackedRLEs":
+        """Returns a copy where the RLEs at indices idx are replaced by other's."""
+        assert len(idx) == len(other), "Need one replacement RLE per index."
+        order = np.arange(self._len)
+        order[np.asarray(idx, dtype=np.int64)] = self._len + np.arange(len(other))
+        return PackedRLEs.cat([self, other])[order]
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        return list(self)
+
+    def _run_info(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns each run's mask index, start within its mask, and parity."""
+        lengths = self.lengths
+        mask_idxs = np.repeat(np.arange(self._len), lengths)
+        run_idxs = np.arange(self._num_counts) - self.offsets[:-1][mask_idxs]
+        ends = np.cumsum(self.counts, dtype=np.int64)
+        starts = ends - self.counts
+        starts = starts - starts[self.offsets[:-1][mask_idxs]]
+        return mask_idxs, starts, run_idxs % 2 == 1
+
+    def areas(self) -> np.ndarray:
+        """Returns the number of set pixels of each mask."""
+        mask_idxs, _, is_set = self._run_info()
+        areas = np.zeros(self._len, dtype=np.int64)
+        np.add.at(areas, mask_idxs[is_set], self.counts[is_set])
+        return areas
+
+    def boxes(self) -> np.ndarray:
+        """
+        Returns the boxes around the masks in XYXY format, as computed by
+        batched_mask_to_box. Empty masks get the box [0, 0, 0, 0].
+        """
+        mask_idxs, starts, is_set = self._run_info()
+        is_set &= self.counts > 0
+        mask_idxs, starts = mask_idxs[is_set], starts[is_set]
+        ends = starts + self.counts[is_set] - 1
+        h = self.sizes[mask_idxs, 0].astype(np.int64)
+        # Runs go down the columns. A run that spans several columns
+        # covers every row in between.
+        x0, x1 = starts // h, ends // h
+        multi_column = x1 > x0
+        y0 = np.where(multi_column, 0, starts % h)
+        y1 = np.where(multi_column, h - 1, ends % h)
+        boxes = np.zeros((self._len, 4), dtype=np.int64)
+        if len(mask_idxs) > 0:
+            nonempty, first_run = np.unique(mask_idxs, return_index=True)
+            boxes[nonempty, 0] = np.minimum.reduceat(x0, first_run)
+            boxes[nonempty, 1] = np.minimum.reduceat(y0, first_run)
+            boxes[nonempty, 2] = np.maximum.reduceat(x1, first_run)
+            boxes[nonempty, 3] = np.maximum.reduceat(y1, first_run)
+        return boxes
+
+
+def _grow(buffer: np.ndarray, capacity: int, length: int) -> np.ndarray:
+    new_buffer = np.empty((capacity, *buffer.shape[1:]), dtype=buffer.dtype)
+    new_buffer[:length] = buffer[:length]
+    return new_buffer
+
+
 def is_box_near_crop_edge(
-    boxes: torch.Tensor, crop_box: List[int], orig_box: List[int], atol: float = 20.0
+    boxes: torch.Tensor,
+    crop_box: List[int],
+    orig_box: List[int],
+    atol: float = 20.0,
+    margin: Union[float, torch.Tensor] = 0.0,
 ) -> torch.Tensor:
-    """Filter masks at the edge of a crop, but not at the edge of the original image."""
+    """
+    Filter masks at the edge of a crop, but not at the edge of the original image.
+    With a margin, a box is only filtered if it would still be when each of its
+    coordinates moved by up to the margin, which may be given per coordinate.
+    """
     crop_box_torch = torch.as_tensor(crop_box, dtype=torch.float, device=boxes.device)
     orig_box_torch = torch.as_tensor(orig_box, dtype=torch.float, device=boxes.device)
     boxes = uncrop_boxes_xyxy(boxes, crop_box).float()
-    near_crop_edge = torch.isclose(boxes, crop_box_torch[None, :], atol=atol, rtol=0)
-    near_image_edge = torch.isclose(boxes, orig_box_torch[None, :], atol=atol, rtol=0)
+    near_crop_edge = (boxes - crop_box_torch[None, :]).abs() <= atol - margin
+    near_image_edge = (boxes - orig_box_torch[None, :]).abs() <= atol + margin
     near_crop_edge = torch.logical_and(near_crop_edge, ~near_image_edge)
     return torch.any(near_crop_edge, dim=1)
 
@@ -116,63 +431,207 @@ def batch_iterator(batch_size: int, *args) -> Generator[List[Any], None, None]:
         yield [arg[b * batch_size : (b + 1) * batch_size] for arg in args]
 
 
+def is_out_of_memory_error(error: BaseException) -> bool:
+    """Returns whether an error was raised by a failed memory allocation."""
+    if isinstance(error, MemoryError):
+        return True
+    message = str(error)
+    return isinstance(error, RuntimeError) and (
+        "out of memory" in message
+        or "not enough memory" in message
+        or "can't allocate memory" in message
+    )
+
+
 def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     """
     Encodes masks to an uncompressed RLE, in the format expected by
     pycoco tools.
     """
+    _, h, w = tensor.shape
+    counts, offsets = mask_to_rle_counts_pytorch(tensor)
+    return rle_counts_to_dicts(counts, offsets, (h, w))
+
+
+def mask_to_rle_counts_pytorch(
+    tensor: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Encodes a batch of BxHxW masks to uncompressed RLEs in a single pass,
+    without looping over the masks. Returns the run lengths of all masks
+    in one flat buffer, along with a length B+1 tensor of offsets so that
+    the counts of mask i are counts[offsets[i] : offsets[i + 1]]. The
+    counts follow the pycoco tools convention and start with a run of zeros.
+    """
     # Put in fortran order and flatten h,w
     b, h, w = tensor.shape
     tensor = tensor.permute(0, 2, 1).flatten(1)
+    device = tensor.device
 
-    # Compute change indices
+    # Compute change indices, sorted by mask and then by position
     diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
-
-    # Encode run length
-    out = []
-    for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
-        out.append({"size": [h, w], "counts": counts})
-    return out
+    mask_idxs, change_idxs = diff.nonzero(as_tuple=True)
+    run_ends = change_idxs + 1
+
+    # Each mask has one run per change plus a final run, and starts with an
+    # empty run of zeros if its first pixel is set
+    n_changes = torch.bincount(mask_idxs, minlength=b)
+    leading_zero = tensor[:, 0].long() if h * w > 0 else n_changes.new_zeros(b)
+    lengths = leading_zero + n_changes + 1
+    offsets = torch.zeros(b + 1, dtype=torch.long, device=device)
+    offsets[1:] = torch.cumsum(lengths, dim=0)
+    first_change = torch.cumsum(n_changes, dim=0) - n_changes
+
+    # Runs that end at a change start at the previous change of the same mask
+    run_idxs = torch.arange(len(change_idxs), device=device) - first_change[mask_idxs]
+    run_starts = torch.zeros_like(run_ends)
+    run_starts[1:] = run_ends[:-1]
+    run_starts[run_idxs == 0] = 0
+    counts = torch.zeros(int(offsets[-1]), dtype=torch.long, device=device)
+    counts[offsets[mask_idxs] + leading_zero[mask_idxs] + run_idxs] = (
+        run_ends - run_starts
+    )
+
+    # The final run of each mask ends at the last pixel
+    last_run_start = torch.zeros_like(n_changes)
+    has_changes = n_changes > 0
+    last_run_start[has_changes] = run_ends[(first_change + n_changes - 1)[has_changes]]
+    counts[offsets[:-1] + leading_zero + n_changes] = h * w - last_run_start
+    return counts, offsets
+
+
+def rle_counts_to_dicts(
+    counts: torch.Tensor, offsets: torch.Tensor, size: Tuple[int, int]
+) -> List[Dict[str, Any]]:
+    """
+    Converts flat RLE counts and offsets, as returned by
+    mask_to_rle_counts_pytorch, to a list of uncompressed RLEs
+    in the format expected by pycoco tools.
+    """
+    h, w = size
+    counts_list = counts.detach().cpu().tolist()
+    offsets_list = offsets.detach().cpu().tolist()
+    return [
+        {"size": [h, w], "counts": counts_list[start:end]}
+        for start, end in zip(offsets_list[:-1], offsets_list[1:])
+    ]
+
+
+def window_mask_to_rle_pytorch(
+    window: torch.Tensor, offset: Tuple[int, int], size: Tuple[int, int]
+) -> Dict[str, Any]:
+    """
+    Encodes a mask that is only nonzero within a window to an uncompressed
+    RLE of the full mask, without building the full mask. The window's top
+    left corner is at offset=(x, y) in the full mask of size=(h, w).
+    """
+    h, w = size
+    counts = window_mask_to_rle_counts_pytorch(window, offset, size)
+    return {"size": [h, w], "counts": counts.detach().cpu().tolist()}
+
+
+def window_mask_to_rle_counts_pytorch(
+    window: torch.Tensor, offset: Tuple[int, int], size: Tuple[int, int]
+) -> torch.Tensor:
+    """
+    Same as window_mask_to_rle_pytorch, but returns the RLE counts as a
+    tensor on the window's device.
+    """
+    h, w = size
+    x0, y0 = offset
+    # Pad each column of the window with a zero above and below, so that
+    # every run inside the window starts and ends with a change
+    window = torch.nn.functional.pad(window.t(), (1, 1), value=0)
+    diff = window[:, 1:] ^ window[:, :-1]
+    cols, rows = diff.nonzero(as_tuple=True)
+    change_indices = (cols + x0) * h + (rows + y0)
+    # The change below a column that ends at the image's bottom edge coincides
+    # with the change above the next column if that starts at the top edge.
+    # Both cancel out when the two pixels around them are set.
+    change_indices, change_counts = torch.unique(change_indices, return_counts=True)
+    change_indices = change_indices[(change_counts == 1) & (change_indices < h * w)]
+    bounds = change_indices.new_tensor([0, h * w])
+    change_indices = torch.cat([bounds[:1], change_indices, bounds[1:]])
+    return change_indices[1:] - change_indices[:-1]
 
 
 def rle_to_mask_torch(rle: Dict[str, Any], device="cuda") -> torch.Tensor:
     """Compute a binary mask from an uncompressed RLE and return it as a torch tensor on CUDA."""
-    h, w = rle["size"]
-    mask = torch.empty(h * w, dtype=torch.bool, device=device)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
-    mask = mask.view(w, h).t()  # Put in C order
-    return mask
+    return rles_to_masks_torch([rle], device=device)[0]
 
 
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
-    h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
-    mask = mask.reshape(w, h)
-    return mask.transpose()  # Put in C order
+    return rles_to_masks([rle])[0]
+
+
+def _flatten_rle_counts(
+    rles: Union[List[Dict[str, Any]], "PackedRLEs"]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Concatenates the counts of several uncompressed RLEs of the same size.
+    Returns the counts and the parity of each run, which is True for runs of
+    ones. Counts alternate between zeros and ones in each RLE, starting with
+    zeros.
+    """
+    if not isinstance(rles, PackedRLEs):
+        rles = PackedRLEs.from_dicts(rles)
+    assert (rles.sizes == rles.sizes[:1]).all(), "All RLEs must have the same size."
+    lengths = rles.lengths
+    run_starts = np.repeat(rles.offsets[:-1], lengths)
+    parities = (np.arange(len(rles.counts)) - run_starts) % 2 == 1
+    return rles.counts, parities
+
+
+def rles_to_masks(rles: Union[List[Dict[str, Any]], "PackedRLEs"]) -> np.ndarray:
+    """
+    Computes binary masks from a list of uncompressed RLEs of the same size,
+    without looping over runs. Returns an array of shape NxHxW, which is
+    allocated once and filled by repeating each run's value.
+    """
+    if len(rles) == 0:
+        return np.zeros((0, 0, 0), dtype=bool)
+    h, w = rles[0]["size"]
+    counts, parities = _flatten_rle_counts(rles)
+    masks = np.repeat(parities, counts).reshape(len(rles), w, h)
+    return masks.transpose(0, 2, 1)  # Put in C order
+
+
+def rles_to_masks_torch(
+    rles: Union[List[Dict[str, Any]], "PackedRLEs"], device="cuda"
+) -> torch.Tensor:
+    """
+    Computes binary masks from a list of uncompressed RLEs of the same size,
+    as rles_to_masks does, and returns them as a NxHxW torch tensor on device.
+    """
+    if len(rles) == 0:
+        return torch.zeros((0, 0, 0), dtype=torch.bool, device=device)
+    h, w = rles[0]["size"]
+    counts, parities = _flatten_rle_counts(rles)
+    masks = torch.repeat_interleave(
+        torch.as_tensor(parities, device=device), torch.as_tensor(counts, device=device)
+    )
+    return masks.view(len(rles), w, h).transpose(1, 2)  # Put in C order
+
+
+def rles_to_packed_masks(
+    rles: Union[List[Dict[str, Any]], "PackedRLEs"], chunk_size: int = 16
+) -> np.ndarray:
+    """
+    Computes bit-packed binary masks from a list of uncompressed RLEs of the
+    same size. Returns a uint8 array of shape Nxceil(H*W/8) holding each
+    mask's pixels in C order, as given by np.packbits. Masks are decoded
+    chunk_size at a time, so only that many unpacked masks exist at once.
+    """
+    if len(rles) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    h, w = rles[0]["size"]
+    packed = np.empty((len(rles), (h * w + 7) // 8), dtype=np.uint8)
+    for i_chunk, (chunk,) in enumerate(batch_iterator(chunk_size, rles)):
+        masks = rles_to_masks(chunk).reshape(len(chunk), h * w)
+        start = i_chunk * chunk_size
+        packed[start : start + len(chunk)] = np.packbits(masks, axis=-1)
+    return packed
 
 
 def area_from_rle(rle: Dict[str, Any]) -> int:
@@ -223,6 +682,24 @@ def build_all_layer_point_grids(
     return points_by_layer
 
 
+def coarse_to_fine_order(points: np.ndarray) -> np.ndarray:
+    """
+    Returns an order over points on a grid that starts with a coarse subgrid
+    and refines it. A point comes earlier the larger the power of two that
+    divides both of its row and column indices among the points' coordinates.
+    The order is stable within each level.
+    """
+    if len(points) == 0:
+        return np.zeros(0, dtype=np.int64)
+    _, cols = np.unique(points[:, 0], return_inverse=True)
+    _, rows = np.unique(points[:, 1], return_inverse=True)
+    indices = (cols | rows).reshape(-1)
+    # The lowest set bit is the largest power of two dividing both indices
+    strides = indices & -indices
+    strides[indices == 0] = np.iinfo(strides.dtype).max
+    return np.argsort(-strides, kind="stable")
+
+
 def generate_crop_boxes(
     im_size: Tuple[int, ...], n_layers: int, overlap_ratio: float
 ) -> Tuple[List[List[int]], List[int]]:
@@ -305,6 +782,49 @@ def uncrop_points(points: torch.Tensor, crop_box: List[int]) -> torch.Tensor:
     return points + offset
 
 
+class SummedAreaTable:
+    """
+    A summed-area table of an HW array, which gives the sum of the array over
+    any box in constant time. Boxes are in XYXY format with exclusive ends,
+    and are clipped to the array.
+    """
+
+    def __init__(self, values: np.ndarray) -> None:
+        h, w = values.shape
+        dtype: type = np.float64
+        if values.dtype == bool:
+            dtype = np.int32 if h * w < 2**31 else np.int64
+        self.table = np.zeros((h + 1, w + 1), dtype=dtype)
+        np.cumsum(values, axis=0, dtype=dtype, out=self.table[1:, 1:])
+        np.cumsum(self.table[1:, 1:], axis=1, out=self.table[1:, 1:])
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        h, w = self.table.shape
+        return h - 1, w - 1
+
+    def _clip_boxes(
+        self, boxes: Union[np.ndarray, List[List[int]]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        h, w = self.shape
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        x0, y0 = np.clip(boxes[:, 0], 0, w), np.clip(boxes[:, 1], 0, h)
+        x1, y1 = np.clip(boxes[:, 2], x0, w), np.clip(boxes[:, 3], y0, h)
+        return x0, y0, x1, y1
+
+    def box_sums(self, boxes: Union[np.ndarray, List[List[int]]]) -> np.ndarray:
+        """Returns the sum over each of an Nx4 array of boxes."""
+        x0, y0, x1, y1 = self._clip_boxes(boxes)
+        t = self.table
+        return t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0]
+
+    def box_means(self, boxes: Union[np.ndarray, List[List[int]]]) -> np.ndarray:
+        """Returns the mean over each box, or 0 for boxes with no area."""
+        x0, y0, x1, y1 = self._clip_boxes(boxes)
+        areas = (x1 - x0) * (y1 - y0)
+        return self.box_sums(boxes) / np.maximum(areas, 1)
+
+
 def sample_image(img: np.ndarray, points: np.ndarray) -> np.ndarray:
     """
     Samples the image `img` at the given `points`, returning an array of pixel values.
@@ -346,12 +866,104 @@ def uncrop_masks(
     return torch.nn.functional.pad(masks, pad, value=0)
 
 
+@lru_cache(maxsize=16)
+def mask_upsampling_matrix(
+    low_res_len: int,
+    img_size: int,
+    input_len: int,
+    original_len: int,
+    device: str = "cpu",
+) -> torch.Tensor:
+    """
+    Returns the original_len x low_res_len matrix that applies the upsampling
+    of Sam.postprocess_masks along one axis of a low resolution mask: bilinear
+    resizing to img_size, removal of the padding beyond input_len, and bilinear
+    resizing to original_len. The matrix is built by running those steps on
+    unit impulses, so it uses the same interpolation weights.
+    """
+    impulses = torch.eye(low_res_len, dtype=torch.float, device=device)[None, None]
+    responses = torch.nn.functional.interpolate(
+        impulses, (low_res_len, img_size), mode="bilinear", align_corners=False
+    )
+    responses = responses[..., :input_len]
+    responses = torch.nn.functional.interpolate(
+        responses, (low_res_len, original_len), mode="bilinear", align_corners=False
+    )
+    return responses[0, 0].t().contiguous()
+
+
+def upsample_mask_window(
+    low_res_mask: torch.Tensor,
+    matrix_y: torch.Tensor,
+    matrix_x: torch.Tensor,
+    threshold: float,
+) -> Tuple[torch.Tensor, Tuple[int, int]]:
+    """
+    Upsamples an HxW low resolution mask with the given upsampling matrices,
+    but only within the smallest window containing every upsampled pixel
+    above threshold. Returns the upsampled values in the window and the
+    window's (x, y) offset. The window is empty if no pixel is above threshold.
+    Low resolution pixels that no upsampled pixel gets weight from, such as
+    those in the padding added before the image encoder, are ignored.
+    """
+    above = low_res_mask > threshold
+    above &= matrix_y.any(dim=0)[:, None] & matrix_x.any(dim=0)[None, :]
+    ys, xs = torch.nonzero(above, as_tuple=True)
+    if len(ys) == 0:
+        return low_res_mask.new_zeros((0, 0)), (0, 0)
+
+    def window_and_support(
+        matrix: torch.Tensor, start: int, end: int
+    ) -> Tuple[int, int, int, int]:
+        # Output pixels that get any weight from the low res pixels in [start, end]
+        rows = torch.nonzero(matrix[:, start : end + 1].any(dim=1)).flatten()
+        row_start, row_end = int(rows[0]), int(rows[-1]) + 1
+        # All low res pixels that those output pixels get weight from
+        cols = torch.nonzero(matrix[row_start:row_end].any(dim=0)).flatten()
+        return row_start, row_end, int(cols[0]), int(cols[-1]) + 1
+
+    y0, y1, low_res_y0, low_res_y1 = window_and_support(
+        matrix_y, int(ys.min()), int(ys.max())
+    )
+    x0, x1, low_res_x0, low_res_x1 = window_and_support(
+        matrix_x, int(xs.min()), int(xs.max())
+    )
+    window = (
+        matrix_y[y0:y1, low_res_y0:low_res_y1]
+        @ low_res_mask[low_res_y0:low_res_y1, low_res_x0:low_res_x1]
+        @ matrix_x[x0:x1, low_res_x0:low_res_x1].t()
+    )
+    return window, (x0, y0)
+
+
 def remove_small_regions(
-    mask: np.ndarray, area_thresh: float, mode: str
+    mask: np.ndarray,
+    area_thresh: float,
+    mode: str,
+    open_edges: Tuple[bool, bool, bool, bool] = (False, False, False, False),
 ) -> Tuple[np.ndarray, bool]:
     """
     Removes small disconnected regions and holes in a mask. Returns the
     mask and an indicator of if the mask has been modified.
+
+    open_edges marks the left, top, right and bottom edges of a mask cut
+    from a larger one that continue into a large unset region. Unset regions
+    touching these edges are never filled as holes.
+    """
+    mask, changed, _ = _remove_small_regions(mask, area_thresh, mode, open_edges)
+    return mask, changed
+
+
+def _remove_small_regions(
+    mask: np.ndarray,
+    area_thresh: float,
+    mode: str,
+    open_edges: Tuple[bool, bool, bool, bool] = (False, False, False, False),
+) -> Tuple[np.ndarray, bool, bool]:
+    """
+    Same as remove_small_regions, but also returns whether the largest region
+    was kept from several of the same size. The one kept then depends on the
+    labelling order of open-cv, which changes when the mask is cut.
     """
     import cv2  # type: ignore
 
@@ -360,17 +972,115 @@ def remove_small_regions(
     working_mask = (correct_holes ^ mask).astype(np.uint8)
     n_labels, regions, stats, _ = cv2.connectedComponentsWithStats(working_mask, 8)
     sizes = stats[:, -1][1:]  # Row 0 is background label
-    small_regions = [i + 1 for i, s in enumerate(sizes) if s < area_thresh]
+    is_small = sizes < area_thresh
+    if correct_holes and any(open_edges):
+        edges = [regions[:, 0], regions[0, :], regions[:, -1], regions[-1, :]]
+        edges = [edge for edge, is_open in zip(edges, open_edges) if is_open]
+        is_small[np.unique(np.concatenate(edges)) - 1] = False
+    small_regions = np.flatnonzero(is_small) + 1
     if len(small_regions) == 0:
-        return mask, False
-    fill_labels = [0] + small_regions
+        return mask, False, False
+    fill = np.zeros(n_labels, dtype=bool)
+    fill[0] = True
+    fill[small_regions] = True
+    tied = False
     if not correct_holes:
-        fill_labels = [i for i in range(n_labels) if i not in fill_labels]
+        fill = ~fill
         # If every region is below threshold, keep largest
-        if len(fill_labels) == 0:
-            fill_labels = [int(np.argmax(sizes)) + 1]
-    mask = np.isin(regions, fill_labels)
-    return mask, True
+        if not fill.any():
+            fill[int(np.argmax(sizes)) + 1] = True
+            tied = int((sizes == sizes.max()).sum()) > 1
+    mask = fill[regions]
+    return mask, True, tied
+
+
+def rle_counts_to_window(
+    counts: np.ndarray, size: Tuple[int, int], box: List[int]
+) -> np.ndarray:
+    """
+    Decodes the part of a mask inside an XYXY box, with inclusive bounds,
+    from the mask's uncompressed RLE counts. Only the columns spanned by
+    the box are decoded.
+    """
+    h, _ = size
+    x0, y0, x1, y1 = box
+    ends = np.cumsum(counts, dtype=np.int64)
+    starts = ends - counts
+    # Clip the runs to the box's columns, which are contiguous in the RLE
+    start, end = x0 * h, (x1 + 1) * h
+    lengths = np.clip(ends, start, end) - np.clip(starts, start, end)
+    values = np.arange(len(counts)) % 2 == 1
+    columns = np.repeat(values, lengths).reshape(x1 - x0 + 1, h)
+    return np.ascontiguousarray(columns[:, y0 : y1 + 1].T)
+
+
+def remove_small_regions_in_box(
+    counts: np.ndarray, size: Tuple[int, int], box: List[int], area_thresh: float
+) -> Tuple[np.ndarray, Tuple[int, int], bool]:
+    """
+    Removes small holes, then small disconnected regions, from a mask given
+    by its uncompressed RLE counts and XYXY box, as remove_small_regions does
+    on the full mask. Only the window around the box is decoded and cleaned.
+    Returns the window, its XY offset in the mask, and an indicator of if
+    the mask has been modified.
+
+    The whole mask is used if it is empty, if the unset region outside the
+    box has a connected part smaller than area_thresh, which would then be
+    a hole of the full mask, or if the region to keep is ambiguous.
+    """
+    h, w = size
+    x0, y0, x1, y1 = box
+    if np.any(counts[1::2]) and _outside_box_is_large(size, box, area_thresh):
+        # Keep a row or column of the unset region on the sides of the box
+        # that do not meet the image edge
+        x0, y0 = max(x0 - 1, 0), max(y0 - 1, 0)
+        x1, y1 = min(x1 + 1, w - 1), min(y1 + 1, h - 1)
+        open_edges = (x0 < box[0], y0 < box[1], x1 > box[2], y1 > box[3])
+    else:
+        x0, y0, x1, y1 = 0, 0, w - 1, h - 1
+        open_edges = (False, False, False, False)
+    window = rle_counts_to_window(counts, size, [x0, y0, x1, y1])
+    window, changed_holes = remove_small_regions(
+        window, area_thresh, mode="holes", open_edges=open_edges
+    )
+    window, changed_islands, tied = _remove_small_regions(
+        window, area_thresh, mode="islands"
+    )
+    if tied and window.shape != (h, w):
+        # Break the tie between the largest regions as on the full mask
+        mask = rle_counts_to_window(counts, size, [0, 0, w - 1, h - 1])
+        mask, changed_holes = remove_small_regions(mask, area_thresh, mode="holes")
+        mask, changed_islands = remove_small_regions(mask, area_thresh, mode="islands")
+        return mask, (0, 0), changed_holes or changed_islands
+    return window, (x0, y0), changed_holes or changed_islands
+
+
+def _outside_box_is_large(
+    size: Tuple[int, int], box: List[int], area_thresh: float
+) -> bool:
+    """Checks that each connected part of an image outside an XYXY box is large."""
+    h, w = size
+    x0, y0, x1, y1 = box
+    if x0 == 0 and x1 == w - 1:
+        parts = [y0 * w, (h - 1 - y1) * w]
+    elif y0 == 0 and y1 == h - 1:
+        parts = [x0 * h, (w - 1 - x1) * h]
+    else:
+        parts = [h * w - (x1 - x0 + 1) * (y1 - y0 + 1)]
+    return all(part == 0 or part >= area_thresh for part in parts)
+
+
+def window_to_box(window: np.ndarray, offset: Tuple[int, int]) -> List[int]:
+    """
+    Returns the XYXY box around a mask given as a window and its XY offset,
+    as computed by batched_mask_to_box. An empty mask gets [0, 0, 0, 0].
+    """
+    rows = np.flatnonzero(window.any(axis=1))
+    cols = np.flatnonzero(window.any(axis=0))
+    if len(rows) == 0:
+        return [0, 0, 0, 0]
+    x, y = offset
+    return [int(cols[0]) + x, int(rows[0]) + y, int(cols[-1]) + x, int(rows[-1]) + y]
 
 
 def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
@@ -443,21 +1153,149 @@ class FeatureSpec:
 
 @dataclass
 class FeatureCache:
-    cached_features: Dict[str, FeatureSpec] = field(default_factory=dict)
+    """
+    A cache of image features, keyed by a hash of the image and the crop box.
+    The image key from 'image_key' can be computed once per image and turned
+    into the keys of its crops with 'crop_key', for use with 'get_by_key' and
+    'store_by_key'. 'get' and 'store' hash the given image on each call.
+
+    Entries are evicted in least recently used order, or in insertion order
+    with eviction_policy='fifo'. Subclasses can implement other policies by
+    overriding '_touch', called on each hit, and '_eviction_candidates'. The
+    cache holds at most max_cache_size entries and, if max_cache_bytes is not
+    None, at most that many bytes of features on each device. It may also be
+    a dict from device names, such as 'cuda:0', to their limits, in which case
+    devices that are not listed are not limited. An entry larger than the
+    limit of its device, or any entry if max_cache_size is 0, is not stored
+    in memory.
+
+    If disk_cache_dir is not None, every stored entry is also written to a
+    file in that directory, which persists across runs and may be shared by
+    several processes. Entries missing from memory are then read from their
+    file as a zero-copy memory map on the CPU, and kept in memory. If
+    max_disk_bytes is not None, the least recently used files are deleted
+    when the directory holds more than that many bytes.
+
+    hits, misses and evictions count the lookups and memory evictions since
+    the cache was created, with disk_hits counting the hits read from disk,
+    and resident_bytes gives the bytes of features held on each device. The
+    cache may be shared between threads.
+    """
+
+    cached_features: Dict[str, FeatureSpec] = field(default_factory=OrderedDict)
     hashing_decimals: int = 6
     max_cache_size: int = 10000
+    max_cache_bytes: Optional[Union[int, Dict[str, int]]] = None
+    eviction_policy: str = "lru"
+    disk_cache_dir: Optional[str] = None
+    max_disk_bytes: Optional[int] = None
+    hits: int = field(default=0, init=False)
+    misses: int = field(default=0, init=False)
+    evictions: int = field(default=0, init=False)
+    disk_hits: int = field(default=0, init=False)
+    resident_bytes: Dict[str, int] = field(default_factory=dict, init=False)
+    _lock: threading.RLock = field(
+        default_factory=threading.RLock, init=False, repr=False, compare=False
+    )
+    _disk: Optional[DiskFeatureStore] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self) -> None:
+        assert self.eviction_policy in [
+            "lru",
+            "fifo",
+        ], f"Unknown eviction_policy {self.eviction_policy}."
+        entries = self.cached_features
+        self.cached_features = OrderedDict()
+        for key, features in entries.items():
+            self._insert(key, features)
+        if self.disk_cache_dir is not None:
+            self._disk = DiskFeatureStore(self.disk_cache_dir, self.max_disk_bytes)
 
     @staticmethod
     def _array_hash(x: Union[torch.Tensor, np.ndarray], decimals=6) -> str:
-        """Hashes a numpy array."""
+        """
+        Hashes the raw bytes, shape and dtype of an array. Float arrays are
+        first rounded to the given number of decimals. Uses the xxhash package
+        if it is installed, and BLAKE2 otherwise.
+        """
         if torch.is_tensor(x):
             x = x.detach().cpu().numpy()
-        return hashlib.sha256(np.round(x, decimals).tobytes()).hexdigest()
+        x = np.asarray(x)
+        if np.issubdtype(x.dtype, np.floating):
+            x = np.round(x, decimals)
+        x = np.ascontiguousarray(x)
+        data = x.reshape(-1).view(np.uint8).data
+        try:
+            import xxhash  # type: ignore
+
+            digest = xxhash.xxh3_128_hexdigest(data)
+        except ImportError:
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        shape = "x".join([str(s) for s in x.shape])
+        return f"{digest}_{x.dtype.str}_{shape}"
+
+    def image_key(self, image: Union[torch.Tensor, np.ndarray]) -> str:
+        """Returns the key of a full image, from which crop keys are derived."""
+        return self._array_hash(image, decimals=self.hashing_decimals)
+
+    @staticmethod
+    def crop_key(image_key: str, crop_box: List[int]) -> str:
+        """Returns the key of a crop of the image with the given key."""
+        crop_box_str = ",".join([str(int(x)) for x in crop_box])
+        return f"{image_key}_{crop_box_str}"
 
     def make_key(self, image: Union[torch.Tensor, np.ndarray], crop_box: List[int]):
-        image_hash = self._array_hash(image, decimals=self.hashing_decimals)
-        crop_box_str = ",".join([str(x) for x in crop_box])
-        return f"{image_hash}_{crop_box_str}"
+        return self.crop_key(self.image_key(image), crop_box)
+
+    @staticmethod
+    def _feature_device(features: FeatureSpec) -> str:
+        return str(features.features.device)
+
+    @staticmethod
+    def _feature_bytes(features: FeatureSpec) -> int:
+        return features.features.numel() * features.features.element_size()
+
+    def _device_limit(self, device: str) -> Optional[int]:
+        if isinstance(self.max_cache_bytes, dict):
+            return self.max_cache_bytes.get(device)
+        return self.max_cache_bytes
+
+    def _touch(self, key: str) -> None:
+        """Records a hit on a cached key."""
+        if self.eviction_policy == "lru":
+            self.cached_features.move_to_end(key)  # type: ignore
+
+    def _eviction_candidates(self, device: Optional[str] = None) -> Iterator[str]:
+        """
+        Yields the cached keys in the order they should be evicted, only
+        those of features on the given device if it is not None.
+        """
+        for key, features in self.cached_features.items():
+            if device is None or self._feature_device(features) == device:
+                yield key
+
+    def _insert(self, key: str, features: FeatureSpec) -> None:
+        self._remove(key)
+        self.cached_features[key] = features
+        device = self._feature_device(features)
+        self.resident_bytes[device] = (
+            self.resident_bytes.get(device, 0) + self._feature_bytes(features)
+        )
+
+    def _remove(self, key: str) -> Optional[FeatureSpec]:
+        features = self.cached_features.pop(key, None)
+        if features is not None:
+            self.resident_bytes[self._feature_device(features)] -= (
+                self._feature_bytes(features)
+            )
+        return features
+
+    def _evict(self, device: Optional[str] = None) -> None:
+        key = next(self._eviction_candidates(device))
+        self._remove(key)
+        self.evictions += 1
 
     def store(
         self,
@@ -466,13 +1304,30 @@ class FeatureCache:
         features: FeatureSpec,
     ):
         """Stores a feature in cache."""
-        # First, hash the image
-        key = self.make_key(image, crop_box)
-        self.cached_features[key] = features
-        # If the cache is too large, remove the oldest entry
-        if len(self.cached_features) > self.max_cache_size:
-            first_key = next(iter(self.cached_features.keys()))
-            self.cached_features.pop(first_key)
+        self.store_by_key(self.make_key(image, crop_box), features)
+
+    def store_by_key(self, key: str, features: FeatureSpec) -> None:
+        """Stores a feature in cache under a key from 'make_key' or 'crop_key'."""
+        self._store_in_memory(key, features)
+        if self._disk is not None:
+            self._disk.put(
+                key, features.features, features.original_size, features.input_size
+            )
+
+    def _store_in_memory(self, key: str, features: FeatureSpec) -> None:
+        device = self._feature_device(features)
+        limit = self._device_limit(device)
+        if limit is not None and self._feature_bytes(features) > limit:
+            return
+        if self.max_cache_size <= 0:
+            return
+        with self._lock:
+            self._insert(key, features)
+            # Evict entries until the cache is within its limits
+            while len(self.cached_features) > self.max_cache_size:
+                self._evict()
+            while limit is not None and self.resident_bytes[device] > limit:
+                self._evict(device)
 
     def build_feature_spec_and_store(
         self,
@@ -496,12 +1351,49 @@ class FeatureCache:
         default: Any = None,
     ) -> Union[FeatureSpec, Any]:
         """Gets a feature from cache."""
-        key = self.make_key(image, crop_box)
-        return self.cached_features.get(key, default)
-
-    def clear(self):
-        """Clears the cache."""
-        self.cached_features = {}
+        return self.get_by_key(self.make_key(image, crop_box), default)
+
+    def get_by_key(self, key: str, default: Any = None) -> Union[FeatureSpec, Any]:
+        """Gets a feature from cache by a key from 'make_key' or 'crop_key'."""
+        with self._lock:
+            features = self.cached_features.get(key)
+            if features is not None:
+                self.hits += 1
+                self._touch(key)
+                return features
+        if self._disk is not None:
+            entry = self._disk.get(key)
+            if entry is not None:
+                features = FeatureSpec(*entry)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                self._store_in_memory(key, features)
+                return features
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def clear(self, disk: bool = False):
+        """Clears the cache in memory, and its files on disk if disk is True."""
+        with self._lock:
+            self.cached_features = OrderedDict()
+            self.resident_bytes = {}
+        if disk and self._disk is not None:
+            self._disk.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the cache's counters, entry count and resident bytes."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_hits": self.disk_hits,
+                "disk_evictions": 0 if self._disk is None else self._disk.evictions,
+                "entries": len(self.cached_features),
+                "resident_bytes": dict(self.resident_bytes),
+            }
 
     def __len__(self):
         return len(self.cached_features)
@@ -517,3 +1409,69 @@ class FeatureCache:
         return partial(
             self.build_feature_spec_and_store, image=image, crop_box=crop_box
         )
+
+    def get_retriever_for_key(self, key: str) -> Callable:
+        return partial(self.get_by_key, key=key, default=None)
+
+    def get_cacher_for_key(self, key: str) -> Callable:
+        def cacher(
+            features: torch.Tensor,
+            input_size: Tuple[int, int],
+            original_size: Tuple[int, int],
+        ) -> None:
+            feature_spec = FeatureSpec(
+                features=features,
+                input_size=input_size,
+                original_size=original_size,
+            )
+            self.store_by_key(key, feature_spec)
+
+        return cacher
+
+
+@dataclass
+class SharedMemoryFeatureCache(FeatureCache):
+    """
+    A FeatureCache shared by all processes on one Linux machine that use the
+    same name, so that a crop encoded by one process is not encoded again by
+    the others. Each entry is a shared memory segment, a file under shm_root
+    that processes memory-map without copying, and the directory of these
+    segments is the shared index. Entries are inserted by atomic renames and
+    evicted by unlinking, which leaves them readable by processes that have
+    them mapped, so any number of processes may insert and evict at once.
+
+    The least recently used entries are evicted when the segments take more
+    than max_shared_bytes, which defaults to 4 GiB. The segments live in
+    memory and outlive every process that uses them, until they are evicted,
+    cleared with 'clear(disk=True)', or removed with their directory
+    shm_root/name by 'unlink'. Entries are not also kept in each process's
+    memory unless max_cache_size is set, and features read from shared
+    memory are on the CPU. Hits from shared memory are counted by disk_hits.
+    """
+
+    name: str = "segment_anything_features"
+    max_shared_bytes: int = 4 << 30
+    shm_root: str = "/dev/shm"
+    max_cache_size: int = 0
+
+    def __post_init__(self) -> None:
+        assert os.path.isdir(
+            self.shm_root
+        ), f"Shared memory root {self.shm_root} does not exist."
+        assert (
+            self.max_shared_bytes is not None and self.max_shared_bytes > 0
+        ), "SharedMemoryFeatureCache requires a positive max_shared_bytes."
+        self.disk_cache_dir = os.path.join(self.shm_root, self.name)
+        self.max_disk_bytes = self.max_shared_bytes
+        super().__post_init__()
+
+    def unlink(self) -> None:
+        """
+        Clears the cache and removes its shared memory directory, releasing
+        the memory of entries not mapped by any process. This cache no
+        longer uses shared memory afterwards, and other processes using the
+        same name must not insert entries.
+        """
+        self.clear()
+        self._disk = None
+        shutil.rmtree(self.disk_cache_dir, ignore_errors=True)  # type: ignore
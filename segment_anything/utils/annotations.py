@@ -0,0 +1,272 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, Generator, List, Optional, Sequence, Union, overload
+
+from .amg import MaskData, PackedRLEs, coco_encode_rle, rles_to_masks
+
+
+class MaskAnnotations:
+    """
+    A lazy collection of the mask records produced by SamAutomaticMaskGenerator.
+    Record fields are held column by column in arrays, and masks are kept as
+    PackedRLEs until a segmentation is accessed. The collection can be filtered
+    on area, quality scores and boxes without decoding any mask.
+
+    Iterating or indexing with an int gives MaskAnnotation records, which
+    support the same keys as the dicts returned by 'generate'. Indexing with
+    a slice, index array or boolean mask gives a new MaskAnnotations.
+    """
+
+    __slots__ = (
+        "rles",
+        "areas",
+        "boxes",
+        "predicted_ious",
+        "points",
+        "stability_scores",
+        "crop_boxes",
+        "output_mode",
+    )
+
+    def __init__(
+        self,
+        rles: PackedRLEs,
+        areas: np.ndarray,
+        boxes: np.ndarray,
+        predicted_ious: np.ndarray,
+        points: np.ndarray,
+        stability_scores: np.ndarray,
+        crop_boxes: np.ndarray,
+        output_mode: str = "binary_mask",
+    ) -> None:
+        """
+        Arguments:
+          rles (PackedRLEs): The masks.
+          areas (np.ndarray): The area in pixels of each mask.
+          boxes (np.ndarray): The box around each mask, in XYWH format.
+          predicted_ious (np.ndarray): The model's prediction of each mask's quality.
+          points (np.ndarray): The point input to the model for each mask.
+          stability_scores (np.ndarray): The stability score of each mask.
+          crop_boxes (np.ndarray): The crop used to generate each mask, in XYWH format.
+          output_mode (str): The form segmentations are decoded to. Can be
+            'binary_mask', 'uncompressed_rle', or 'coco_rle'.
+        """
+        self.rles = rles
+        self.areas = areas
+        self.boxes = boxes
+        self.predicted_ious = predicted_ious
+        self.points = points
+        self.stability_scores = stability_scores
+        self.crop_boxes = crop_boxes
+        self.output_mode = output_mode
+
+    @classmethod
+    def from_mask_data(
+        cls, mask_data: MaskData, output_mode: str = "binary_mask"
+    ) -> "MaskAnnotations":
+        """Builds the collection from the MaskData returned by _generate_masks."""
+        rles = mask_data["rles"]
+        if not isinstance(rles, PackedRLEs):
+            rles = PackedRLEs.from_dicts(rles)
+        return cls(
+            rles=rles,
+            areas=rles.areas(),
+            boxes=_xyxy_to_xywh(np.asarray(mask_data["boxes"])),
+            predicted_ious=np.asarray(mask_data["iou_preds"]),
+            points=np.asarray(mask_data["points"]),
+            stability_scores=np.asarray(mask_data["stability_score"]),
+            crop_boxes=_xyxy_to_xywh(np.asarray(mask_data["crop_boxes"])),
+            output_mode=output_mode,
+        )
+
+    def __len__(self) -> int:
+        return len(self.rles)
+
+    def __iter__(self) -> Generator["MaskAnnotation", None, None]:
+        for idx in range(len(self)):
+            yield MaskAnnotation(self, idx)
+
+    @overload
+    def __getitem__(self, idx: Union[int, np.integer]) -> "MaskAnnotation":
+        ...
+
+    @overload
+    def __getitem__(
+        self, idx: Union[slice, Sequence[int], np.ndarray, torch.Tensor]
+    ) -> "MaskAnnotations":
+        ...
+
+    def __getitem__(self, idx: Any) -> Union["MaskAnnotation", "MaskAnnotations"]:
+        if isinstance(idx, (int, np.integer)):
+            if not -len(self) <= idx < len(self):
+                raise IndexError(f"Index {idx} is out of range.")
+            return MaskAnnotation(self, int(idx) % len(self))
+        if torch.is_tensor(idx):
+            idx = idx.detach().cpu().numpy()
+        if not isinstance(idx, slice):
+            idx = np.asarray(idx)
+        return MaskAnnotations(
+            rles=self.rles[idx],
+            areas=self.areas[idx],
+            boxes=self.boxes[idx],
+            predicted_ious=self.predicted_ious[idx],
+            points=self.points[idx],
+            stability_scores=self.stability_scores[idx],
+            crop_boxes=self.crop_boxes[idx],
+            output_mode=self.output_mode,
+        )
+
+    def filter(
+        self,
+        min_area: Optional[int] = None,
+        max_area: Optional[int] = None,
+        min_predicted_iou: Optional[float] = None,
+        min_stability_score: Optional[float] = None,
+        overlapping_box: Optional[List[float]] = None,
+    ) -> "MaskAnnotations":
+        """
+        Returns the records that pass all of the given filters, without
+        decoding any mask.
+
+        Arguments:
+          min_area (int or None): Keep masks with at least this area.
+          max_area (int or None): Keep masks with at most this area.
+          min_predicted_iou (float or None): Keep masks with a predicted IoU
+            of at least this value.
+          min_stability_score (float or None): Keep masks with a stability
+            score of at least this value.
+          overlapping_box (list(float) or None): Keep masks whose box overlaps
+            this box, given in XYWH format.
+        """
+        keep = np.ones(len(self), dtype=bool)
+        if min_area is not None:
+            keep &= self.areas >= min_area
+        if max_area is not None:
+            keep &= self.areas <= max_area
+        if min_predicted_iou is not None:
+            keep &= self.predicted_ious >= min_predicted_iou
+        if min_stability_score is not None:
+            keep &= self.stability_scores >= min_stability_score
+        if overlapping_box is not None:
+            x, y, w, h = overlapping_box
+            x0, y0, bw, bh = self.boxes.T
+            keep &= (x0 <= x + w) & (x0 + bw >= x) & (y0 <= y + h) & (y0 + bh >= y)
+        return self[keep]
+
+    def segmentations(self) -> List[Any]:
+        """Decodes all masks in the collection's output_mode at once."""
+        if self.output_mode == "binary_mask":
+            return list(rles_to_masks(self.rles))
+        elif self.output_mode == "coco_rle":
+            return [coco_encode_rle(rle) for rle in self.rles]
+        return self.rles.to_dicts()
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        """Returns the records as the list of dicts returned by 'generate'."""
+        return [
+            {"segmentation": segmentation, **record.to_dict()}
+            for record, segmentation in zip(self, self.segmentations())
+        ]
+
+
+class MaskAnnotation:
+    """
+    A single record of a MaskAnnotations collection. Fields are read from the
+    collection's arrays on access, and the segmentation is decoded each time
+    it is accessed. Supports dict-style access with the keys of the records
+    returned by 'generate'.
+    """
+
+    __slots__ = ("_annotations", "_idx")
+
+    KEYS = (
+        "segmentation",
+        "area",
+        "bbox",
+        "predicted_iou",
+        "point_coords",
+        "stability_score",
+        "crop_box",
+    )
+
+    def __init__(self, annotations: MaskAnnotations, idx: int) -> None:
+        self._annotations = annotations
+        self._idx = idx
+
+    @property
+    def segmentation(self) -> Union[np.ndarray, Dict[str, Any]]:
+        rle = self._annotations.rles[self._idx]
+        output_mode = self._annotations.output_mode
+        if output_mode == "binary_mask":
+            return rles_to_masks([rle])[0]
+        elif output_mode == "coco_rle":
+            return coco_encode_rle(rle)
+        return rle
+
+    @property
+    def area(self) -> int:
+        return int(self._annotations.areas[self._idx])
+
+    @property
+    def bbox(self) -> List[Any]:
+        return self._annotations.boxes[self._idx].tolist()
+
+    @property
+    def predicted_iou(self) -> float:
+        return self._annotations.predicted_ious[self._idx].item()
+
+    @property
+    def point_coords(self) -> List[List[float]]:
+        return [self._annotations.points[self._idx].tolist()]
+
+    @property
+    def stability_score(self) -> float:
+        return self._annotations.stability_scores[self._idx].item()
+
+    @property
+    def crop_box(self) -> List[Any]:
+        return self._annotations.crop_boxes[self._idx].tolist()
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def keys(self) -> List[str]:
+        return list(self.KEYS)
+
+    def to_dict(self, with_segmentation: bool = False) -> Dict[str, Any]:
+        """Returns the record as a dict, decoding the mask only if requested."""
+        keys = self.KEYS if with_segmentation else self.KEYS[1:]
+        return {key: getattr(self, key) for key in keys}
+
+
+def _xyxy_to_xywh(boxes: np.ndarray) -> np.ndarray:
+    boxes = boxes.copy().reshape(-1, 4)
+    boxes[:, 2] = boxes[:, 2] - boxes[:, 0]
+    boxes[:, 3] = boxes[:, 3] - boxes[:, 1]
+    return boxes
+
+
+@dataclass
+class MaskStreamChunk:
+    """
+    A chunk of the masks streamed by SamAutomaticMaskGenerator.generate_iter.
+    A crop's chunk holds the XYWH crop box, the mask records and their ids,
+    while a reconciliation chunk only holds the ids of suppressed masks.
+    """
+
+    crop_box: Optional[List[int]] = None
+    ids: List[int] = field(default_factory=list)
+    annotations: Union[List[Dict[str, Any]], MaskAnnotations] = field(
+        default_factory=list
+    )
+    suppressed_ids: List[int] = field(default_factory=list)
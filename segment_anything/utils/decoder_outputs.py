@@ -0,0 +1,67 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+import torch.nn.functional as F
+
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+
+@dataclass
+class CropDecoderOutputs:
+    """
+    The raw mask decoder outputs for the prompt points of one crop, with one
+    row per mask. The crop box is in XYXY format and points are in the crop's
+    frame. Only the top-left part of each low resolution mask that is read
+    when upsampling it to the crop is kept, the rest covers the padding added
+    before the image encoder.
+    """
+
+    crop_box: List[int]
+    input_size: Tuple[int, int]
+    low_res_size: Tuple[int, int]
+    low_res_masks: torch.Tensor
+    iou_preds: torch.Tensor
+    points: torch.Tensor
+
+    def __len__(self) -> int:
+        return len(self.iou_preds)
+
+    def full_low_res_masks(self, rows: slice = slice(None)) -> torch.Tensor:
+        """Returns the given rows of low_res_masks zero-padded to full size."""
+        low_res_masks = self.low_res_masks[rows]
+        h, w = low_res_masks.shape[-2:]
+        return F.pad(
+            low_res_masks, (0, self.low_res_size[1] - w, 0, self.low_res_size[0] - h)
+        )
+
+    def nbytes(self) -> int:
+        tensors = [self.low_res_masks, self.iou_preds, self.points]
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+
+@dataclass
+class DecoderOutputs:
+    """
+    The raw mask decoder outputs for an image, as returned by
+    SamAutomaticMaskGenerator.generate_decoder_outputs and re-filtered by
+    SamAutomaticMaskGenerator.refilter. n_crops counts all crops of the image,
+    including those skipped, and masks whose predicted IoU was not over
+    min_pred_iou_thresh were not kept. Tensors are on the CPU, and the whole
+    object can be saved with torch.save.
+    """
+
+    orig_size: Tuple[int, int]
+    n_crops: int
+    min_pred_iou_thresh: float = 0.0
+    crops: List[CropDecoderOutputs] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return sum(len(crop) for crop in self.crops)
+
+    def nbytes(self) -> int:
+        return sum(crop.nbytes() for crop in self.crops)
@@ -0,0 +1,247 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are not available on Windows
+    fcntl = None  # type: ignore[assignment]
+
+# A feature file starts with the magic string and the byte length of a JSON
+# header, followed by the header and by the raw feature tensor, which is
+# aligned to _ALIGNMENT bytes from the start of the file.
+_MAGIC = b"SAMFEATS"
+_VERSION = 1
+_ALIGNMENT = 64
+_SUFFIX = ".feat"
+# Holds the running total of feature file bytes in a directory with a quota
+_USAGE_FILE = ".usage"
+
+# A cached feature tensor with its original and input sizes
+FeatureEntry = Tuple[torch.Tensor, Tuple[int, int], Tuple[int, int]]
+
+
+def write_feature_file(
+    path: str,
+    key: str,
+    features: torch.Tensor,
+    original_size: Tuple[int, int],
+    input_size: Tuple[int, int],
+) -> None:
+    """Writes image features and their sizes to a memory-mappable file."""
+    features = features.detach().cpu().contiguous()
+    data = features.reshape(-1).view(torch.uint8).numpy()
+    header = {
+        "version": _VERSION,
+        "key": key,
+        "dtype": str(features.dtype).replace("torch.", ""),
+        "shape": list(features.shape),
+        "original_size": [int(x) for x in original_size],
+        "input_size": [int(x) for x in input_size],
+    }
+    header_bytes = json.dumps(header).encode()
+    data_offset = _align(len(_MAGIC) + 8 + len(header_bytes))
+    with open(path, "wb") as f:
+        f.write(_MAGIC)
+        f.write(np.array(len(header_bytes), dtype="<u8").tobytes())
+        f.write(header_bytes)
+        f.write(b"\0" * (data_offset - f.tell()))
+        f.write(data.data)
+
+
+def read_feature_file(path: str) -> Tuple[str, FeatureEntry]:
+    """
+    Reads the key and features of a file written by write_feature_file. The
+    features are a copy-on-write memory map of the file, so nothing is read
+    until they are used, and the file is never modified.
+    """
+    buffer = np.memmap(path, dtype=np.uint8, mode="c")
+    magic = bytes(buffer[: len(_MAGIC)])
+    assert magic == _MAGIC, f"{path} is not a feature file."
+    start = len(_MAGIC)
+    header_len = int(buffer[start : start + 8].view("<u8")[0])
+    header = json.loads(bytes(buffer[start + 8 : start + 8 + header_len]))
+    version = header["version"]
+    assert version == _VERSION, f"Unsupported feature file version {version}."
+    data_offset = _align(start + 8 + header_len)
+    dtype = getattr(torch, header["dtype"])
+    shape = header["shape"]
+    nbytes = int(np.prod(shape)) * torch.tensor([], dtype=dtype).element_size()
+    data = torch.from_numpy(buffer[data_offset : data_offset + nbytes])
+    features = data.view(dtype).reshape(shape)
+    return header["key"], (
+        features,
+        tuple(header["original_size"]),  # type: ignore
+        tuple(header["input_size"]),  # type: ignore
+    )
+
+
+class DiskFeatureStore:
+    """
+    A directory of feature files, one for each cache key, which any number of
+    processes may share. Files are replaced atomically, and reads memory-map
+    them, so a file that is deleted stays readable by the processes that have
+    it mapped. If max_bytes is not None, the least recently used files are
+    deleted whenever the directory holds more than max_bytes of feature files,
+    by one process at a time where file locks are available. The bytes held
+    are tracked in an index file, and the directory is only scanned when
+    they go over the quota. Files that cannot be read are treated as misses
+    and deleted.
+    """
+
+    def __init__(self, directory: str, max_bytes: Optional[int] = None) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if max_bytes is not None:
+            # Recount, in case the directory was changed without a quota
+            with self._directory_lock():
+                self._write_usage(self._enforce_quota(max_bytes))
+
+    def _path(self, key: str) -> str:
+        name = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, name + _SUFFIX)
+
+    def get(self, key: str) -> Optional[FeatureEntry]:
+        path = self._path(key)
+        try:
+            file_key, entry = read_feature_file(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # A truncated or corrupt file, e.g. left by a crashed writer
+            _remove(path)
+            return None
+        if file_key != key:
+            return None
+        try:
+            # Mark the file as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted since it was read, but the memory map stays readable
+            pass
+        return entry
+
+    def put(
+        self,
+        key: str,
+        features: torch.Tensor,
+        original_size: Tuple[int, int],
+        input_size: Tuple[int, int],
+    ) -> None:
+        path = self._path(key)
+        if self.max_bytes is not None:
+            nbytes = features.numel() * features.element_size()
+            if nbytes > self.max_bytes:
+                return
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            write_feature_file(tmp_path, key, features, original_size, input_size)
+            if self.max_bytes is None:
+                os.replace(tmp_path, path)
+            else:
+                with self._directory_lock():
+                    old_size = _file_size(path)
+                    os.replace(tmp_path, path)
+                    total = self._read_usage()
+                    if total is not None:
+                        total += _file_size(path) - old_size
+                    if total is None or total > self.max_bytes:
+                        total = self._enforce_quota(self.max_bytes)
+                    self._write_usage(total)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @contextmanager
+    def _directory_lock(self) -> Iterator[None]:
+        """Holds an exclusive lock on the directory between processes."""
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_usage(self) -> Optional[int]:
+        """Reads the bytes held by feature files, or None if not known."""
+        try:
+            with open(os.path.join(self.directory, _USAGE_FILE)) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_usage(self, total: int) -> None:
+        with open(os.path.join(self.directory, _USAGE_FILE), "w") as f:
+            f.write(str(total))
+
+    def _enforce_quota(self, max_bytes: int) -> int:
+        """
+        Deletes the least recently used files until the quota is met, and
+        returns the bytes held by the files that are left.
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                with self._lock:
+                    self.evictions += 1
+            except FileNotFoundError:
+                # Another process removed it first
+                pass
+            total -= size
+        return total
+
+    def clear(self) -> None:
+        """Deletes all feature files in the directory."""
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_SUFFIX):
+                _remove(entry.path)
+        # The next put recounts the directory
+        _remove(os.path.join(self.directory, _USAGE_FILE))
+
+
+def _align(position: int) -> int:
+    return (position + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,167 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import json
+from typing import Any, Dict, Tuple
+
+from .amg import mask_to_rle_pytorch, rles_to_masks, rles_to_packed_masks
+from .annotations import MaskAnnotations
+
+# An archive starts with the magic string and the byte length of a JSON header,
+# followed by the header and by the metadata, offsets and data sections, each
+# aligned to _ALIGNMENT bytes from the start of the file.
+_MAGIC = b"SAMMASKS"
+_VERSION = 1
+_ALIGNMENT = 64
+
+METADATA_DTYPE = np.dtype(
+    [
+        ("area", "<i8"),
+        ("bbox", "<i8", (4,)),
+        ("point_coords", "<f8", (2,)),
+        ("predicted_iou", "<f8"),
+        ("stability_score", "<f8"),
+        ("crop_box", "<i8", (4,)),
+    ]
+)
+
+
+def write_mask_archive(
+    path: str, annotations: MaskAnnotations, mask_format: str = "rle"
+) -> None:
+    """
+    Writes all masks of an image and their metadata to a single file, which can
+    be memory-mapped by MaskArchive for random access to any mask.
+
+    Arguments:
+      path (str): The file to write.
+      annotations (MaskAnnotations): The masks, as returned by
+        SamAutomaticMaskGenerator.generate with lazy_output=True.
+      mask_format (str): How masks are stored. 'rle' stores the uncompressed
+        RLE counts of each mask, and 'bits' stores each mask's pixels in C
+        order, packed 8 to a byte.
+    """
+    assert mask_format in ["rle", "bits"], f"Unknown mask_format {mask_format}."
+    rles = annotations.rles
+    if len(rles) > 0:
+        assert (rles.sizes == rles.sizes[:1]).all(), "Masks must have the same size."
+        h, w = (int(x) for x in rles.sizes[0])
+    else:
+        h, w = 0, 0
+
+    metadata = np.zeros(len(rles), dtype=METADATA_DTYPE)
+    metadata["area"] = annotations.areas
+    metadata["bbox"] = annotations.boxes
+    metadata["point_coords"] = annotations.points
+    metadata["predicted_iou"] = annotations.predicted_ious
+    metadata["stability_score"] = annotations.stability_scores
+    metadata["crop_box"] = annotations.crop_boxes
+
+    if mask_format == "rle":
+        offsets = rles.offsets - rles.offsets[0]
+        data = rles.counts[rles.offsets[0] : rles.offsets[-1]].astype("<u4")
+    else:
+        row_bytes = (h * w + 7) // 8
+        offsets = np.arange(len(rles) + 1, dtype=np.int64) * row_bytes
+        data = rles_to_packed_masks(rles)
+    sections = {
+        "metadata": metadata,
+        "offsets": offsets.astype("<i8"),
+        "data": np.ascontiguousarray(data),
+    }
+
+    # Lay out the sections after the header. The header holds their positions,
+    # so it is laid out again with a longer header until the positions fit.
+    header: Dict[str, Any] = {
+        "version": _VERSION,
+        "mask_format": mask_format,
+        "size": [h, w],
+        "num_masks": len(rles),
+        "sections": {name: [0, 0] for name in sections},
+    }
+    header_bytes = json.dumps(header).encode()
+    header_len = 0
+    while len(header_bytes) > header_len:
+        header_len = len(header_bytes)
+        position = _align(len(_MAGIC) + 8 + header_len)
+        for name, array in sections.items():
+            header["sections"][name] = [position, array.nbytes]
+            position = _align(position + array.nbytes)
+        header_bytes = json.dumps(header).encode()
+    header_bytes = header_bytes.ljust(header_len)
+
+    with open(path, "wb") as f:
+        f.write(_MAGIC)
+        f.write(np.array(header_len, dtype="<u8").tobytes())
+        f.write(header_bytes)
+        for name, array in sections.items():
+            f.write(b"\0" * (header["sections"][name][0] - f.tell()))
+            f.write(array.reshape(-1).view(np.uint8))
+
+
+class MaskArchive:
+    """
+    Reads a mask archive written by write_mask_archive. The file is memory-mapped,
+    so only the masks that are accessed are read from disk.
+
+    Indexing with an int gives that mask as an HW boolean array. The metadata
+    table is a structured array with the fields of METADATA_DTYPE, with boxes
+    in XYWH format.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        magic = bytes(self._buffer[: len(_MAGIC)])
+        assert magic == _MAGIC, f"{path} is not a mask archive."
+        start = len(_MAGIC)
+        header_len = int(self._buffer[start : start + 8].view("<u8")[0])
+        header = json.loads(bytes(self._buffer[start + 8 : start + 8 + header_len]))
+        version = header["version"]
+        assert version == _VERSION, f"Unsupported mask archive version {version}."
+        self.mask_format: str = header["mask_format"]
+        self.size: Tuple[int, int] = tuple(header["size"])  # type: ignore
+        self._num_masks = header["num_masks"]
+
+        sections = header["sections"]
+        self.metadata = self._section(sections["metadata"], METADATA_DTYPE)
+        self.offsets = self._section(sections["offsets"], np.dtype("<i8"))
+        if self.mask_format == "rle":
+            self.data = self._section(sections["data"], np.dtype("<u4"))
+        else:
+            self.data = self._section(sections["data"], np.dtype(np.uint8))
+
+    def _section(self, position: Tuple[int, int], dtype: np.dtype) -> np.ndarray:
+        offset, nbytes = position
+        return self._buffer[offset : offset + nbytes].view(dtype)
+
+    def __len__(self) -> int:
+        return self._num_masks
+
+    def _mask_data(self, idx: int) -> np.ndarray:
+        if not -len(self) <= idx < len(self):
+            raise IndexError(f"Index {idx} is out of range.")
+        idx = int(idx) % len(self)
+        return self.data[self.offsets[idx] : self.offsets[idx + 1]]
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        h, w = self.size
+        data = self._mask_data(idx)
+        if self.mask_format == "rle":
+            return rles_to_masks([{"size": [h, w], "counts": data}])[0]
+        return np.unpackbits(data, count=h * w).reshape(h, w).astype(bool)
+
+    def rle(self, idx: int) -> Dict[str, Any]:
+        """Returns a mask as an uncompressed RLE."""
+        if self.mask_format == "rle":
+            return {"size": list(self.size), "counts": self._mask_data(idx).tolist()}
+        return mask_to_rle_pytorch(torch.as_tensor(self[idx])[None])[0]
+
+
+def _align(position: int) -> int:
+    return (position + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
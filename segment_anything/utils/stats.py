@@ -0,0 +1,152 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+
+@dataclass
+class CropStats:
+    """
+    The work done on one crop of an image. The crop box is in XYWH format,
+    num_masks counts the masks left after NMS within the crop, and
+    stage_times holds the part of each stage's time spent on this crop.
+    """
+
+    image_idx: int
+    crop_box: List[int]
+    num_points: int
+    num_masks: int = 0
+    time: float = 0.0
+    stage_times: Dict[str, float] = field(default_factory=dict)
+
+
+class GenerationStats:
+    """
+    Counts and wall times collected by SamAutomaticMaskGenerator during a call
+    to 'generate', 'generate_batch' or 'generate_iter' that is given this
+    object as its 'stats' argument. Nothing is collected when no object is
+    given. A GenerationStats may be reused to sum over several calls.
+
+    counts holds the number of:
+      crops, crops_skipped_by_score, crops_without_points: crops of the
+        images after the area filters, those skipped on the local score
+        bias and those whose points were all skipped.
+      points, points_skipped_by_score, points_skipped_by_coverage,
+        points_decoded: prompt points of the crops that were not skipped,
+        those skipped on the local score bias or by adaptive point sampling,
+        and those run through the mask decoder.
+      masks_decoded, masks_dropped_by_iou, masks_dropped_by_stability,
+        masks_dropped_by_edge, masks_dropped_by_score, masks_dropped_by_box_nms,
+        masks_dropped_by_crop_nms, masks_dropped_by_small_region_nms, masks:
+        masks from the decoder, those dropped by each filter in the order
+        they are applied, and those returned.
+      feature_cache_hits, feature_cache_misses: crops whose features were
+        found in the feature cache, and those that were looked up but had
+        to be encoded.
+      batch_size_fallbacks: crops rerun with smaller batches after an
+        allocation failed, with memory_budget_bytes. The counts above only
+        include the work of the attempt that succeeded, while the times
+        include all attempts.
+
+    times holds the wall time in seconds of the stages total, setup (crop
+    boxes, points and score tables), encode (crops encoded in batches),
+    set_image, decode, postprocess, box_nms, crop_nms, small_regions and
+    output_encoding. Post-processing runs on a worker thread when it is
+    pipelined, so its time then overlaps that of decoding. Stages are not
+    synchronized with the device, so on GPUs some of the time of a stage may
+    be counted in the next stage that waits on its results.
+
+    crops holds a CropStats for each crop that was processed.
+    """
+
+    def __init__(self) -> None:
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.times: Dict[str, float] = defaultdict(float)
+        self.crops: List[CropStats] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, count: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += int(count)
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.times[stage] += seconds
+
+    def merge(self, other: "GenerationStats", counts: bool = True) -> None:
+        """Adds the times of another GenerationStats, and its counts if counts is True."""
+        with other._lock:
+            other_counts = dict(other.counts) if counts else {}
+            other_times = dict(other.times)
+        with self._lock:
+            for name, count in other_counts.items():
+                self.counts[name] += count
+            for stage, seconds in other_times.items():
+                self.times[stage] += seconds
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def crop(
+        self, image_idx: int, crop_box: List[int], num_points: int
+    ) -> Iterator[CropStats]:
+        """Times the processing of a crop, given in XYWH format."""
+        with self._lock:
+            start_times = dict(self.times)
+        record = CropStats(image_idx, list(crop_box), num_points)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.time = time.perf_counter() - start
+            with self._lock:
+                record.stage_times = {
+                    stage: t - start_times.get(stage, 0.0)
+                    for stage, t in self.times.items()
+                    if t != start_times.get(stage, 0.0)
+                }
+                self.crops.append(record)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "counts": dict(self.counts),
+                "times": dict(self.times),
+                "crops": [vars(crop).copy() for crop in self.crops],
+            }
+
+
+def stage_timer(stats: Optional[GenerationStats], stage: str) -> ContextManager:
+    """Times a stage into stats, or does nothing if stats is None."""
+    if stats is None:
+        return nullcontext()
+    return stats.timer(stage)
+
+
+def crop_timer(
+    stats: Optional[GenerationStats],
+    image_idx: int,
+    crop_box: List[int],
+    num_points: int,
+) -> ContextManager:
+    """
+    Times a crop, given in XYWH format, into stats, yielding its CropStats, or
+    yields None if stats is None.
+    """
+    if stats is None:
+        return nullcontext()
+    return stats.crop(image_idx, crop_box, num_points)